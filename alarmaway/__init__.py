@@ -1,7 +1,7 @@
 from __future__ import absolute_import, division, print_function
 import datetime
 
-from flask import Flask, g, render_template, request, session
+from flask import Flask, render_template, request, session
 from flask.ext.mail import Mail
 from flask.ext.sqlalchemy import SQLAlchemy
 
@@ -15,7 +15,10 @@ def setup_logging(app):
         import logging
 
         #Setup email handling
+        import atexit
         from logging.handlers import SMTPHandler
+        import Queue
+        from .logqueue import DigestMailHandler, QueueHandler, QueueListener
         mail_handler = SMTPHandler((
             app.config['MAIL_SERVER'], app.config['MAIL_PORT']),
             app.config['MAIL_USERNAME'],
@@ -36,8 +39,15 @@ def setup_logging(app):
 
             %(message)s
             ''')
-        mail_handler.setFormatter(mail_formatter)
-        mail_handler.setLevel(logging.ERROR)
+        mail_handler.setFormatter(logging.Formatter('%(message)s'))
+
+        # Errors are mailed as rate limited digests rather than one by one
+        digest_handler = DigestMailHandler(mail_handler,
+            interval=app.config.get('LOG_MAIL_INTERVAL', 300),
+            max_entries=app.config.get('LOG_MAIL_MAX_ENTRIES', 50),
+        )
+        digest_handler.setFormatter(mail_formatter)
+        digest_handler.setLevel(logging.ERROR)
 
         #Setup File logging
         try:
@@ -54,34 +64,62 @@ def setup_logging(app):
         file_handler.setFormatter(file_formatter)
         file_handler.setLevel(logging.DEBUG)
 
+        # Both handlers run on the listener thread, fed through a queue. The
+        # thread starts on the first record logged in each process, so
+        # prefork workers forked after this import get one of their own.
+        log_queue = Queue.Queue(app.config.get('LOG_QUEUE_SIZE', 10000))
+        listener = QueueListener(log_queue, file_handler, digest_handler)
+        atexit.register(listener.stop)
+        queue_handler = QueueHandler(listener)
+
         # Ensure a root logger exists
         root_logger = logging.getLogger('alarmaway')
 
-        # Add handlers to all known loggers
+        # Add the handler to all known loggers
         loggers = [
             app.logger,
             root_logger,
             logging.getLogger('sqlalchemy'),
         ]
         for logger in loggers:
-            logger.addHandler(mail_handler)
-            logger.addHandler(file_handler)
+            if queue_handler not in logger.handlers:
+                logger.addHandler(queue_handler)
 
 def setup_application_handlers(app):
 
+    from .users.cache import load_user
     from .users.forms import LoginForm
-    from .users.models import User
 
-    @app.before_request
-    def before_request():
-        g.user = None
-        if 'user_id' in session:
-            g.user = User.query.filter_by(id=session['user_id']).first()
+    globals_base = getattr(app, 'app_ctx_globals_class', None)
+    if globals_base is None:
+        globals_base = app.request_globals_class
+
+    class LazyUserGlobals(globals_base):
+        """Loads g.user, through the user cache, only when something
+        actually reads it.
+        """
+
+        @property
+        def user(self):
+            if '_user' not in self.__dict__:
+                user_id = session.get('user_id')
+                self.__dict__['_user'] = (
+                    load_user(user_id) if user_id is not None else None)
+            return self.__dict__['_user']
+
+        @user.setter
+        def user(self, value):
+            self.__dict__['_user'] = value
+
+    if hasattr(app, 'app_ctx_globals_class'):
+        app.app_ctx_globals_class = LazyUserGlobals
+    else:
+        app.request_globals_class = LazyUserGlobals
 
     @app.errorhandler(404)
     def page_not_found(error):
         path = request.path
-        app.logger.debug('%s\nPath: %s' % (error, path))
+        app.logger.debug('%s\nPath: %s', error, path)
         form = LoginForm(request.form)
         return render_template('404.html', signin_form=form), 404
 
@@ -95,6 +133,7 @@ def setup_application_handlers(app):
 setup_logging(app)
 from .celery import TaskManager
 task_manager = TaskManager()
+task_manager.init_app(app)
 task_manager.init_db(db)
 
 setup_application_handlers(app)
@@ -137,3 +176,5 @@ from .frontend.views import mod as frontendModule
 app.register_blueprint(frontendModule)
 from .admin.views import mod as adminModule
 app.register_blueprint(adminModule)
+from .api.views import mod as apiModule
+app.register_blueprint(apiModule)
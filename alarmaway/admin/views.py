@@ -1,9 +1,14 @@
 from __future__ import absolute_import
 
-from flask import Blueprint, render_template
+from flask import (Blueprint, Response, abort, g, request,
+        stream_with_context)
+from sqlalchemy.orm import joinedload
 
+from .. import app, db
+from ..timezones import get_local_times
 from .decorators import admin_required
 from ..alarms.models import Alarm
+from ..celery.metrics import DispatchMetrics
 from ..celery.models import ManagedTask
 from ..phones.models import Phone
 from ..users.models import User
@@ -12,14 +17,109 @@ mod = Blueprint('admin', __name__, url_prefix='/checkit')
 import logging
 logger = logging.getLogger("alarmaway")
 
+SECTIONS = ('users', 'phones', 'alarms', 'tasks')
+
+def get_section_query(section):
+    """Returns the query for one admin table, with everything its rows
+    render loaded alongside them.
+    """
+    if section == 'users':
+        return User.query, User.id
+    elif section == 'phones':
+        return Phone.query, Phone.id
+    elif section == 'alarms':
+        return Alarm.query.options(
+            joinedload(Alarm.owner),
+            joinedload(Alarm.phone),
+        ), Alarm.id
+    return ManagedTask.query.options(
+        joinedload(ManagedTask.alarm),
+        joinedload(ManagedTask.phone),
+        joinedload(ManagedTask.user),
+    ), ManagedTask.id
+
+def get_page(section, after=None, size=100):
+    """Returns up to size rows of the section with ids greater than after,
+    and the cursor for the next page (None on the last page). Seeks on the
+    primary key, so every page costs the same.
+    """
+    query, key = get_section_query(section)
+    if after is not None:
+        query = query.filter(key > after)
+    rows = query.order_by(key).limit(size + 1).all()
+    next_after = None
+    if len(rows) > size:
+        rows = rows[:size]
+        next_after = rows[-1].id
+    return rows, next_after
+
+def get_counters():
+    """Counts active alarms, pending tasks and unverified phones in one
+    round trip.
+    """
+    active_alarms = (db.session.query(db.func.count(Alarm.id))
+        .filter(Alarm.active == True)
+        .as_scalar())
+    pending_tasks = (db.session.query(db.func.count(ManagedTask.id))
+        .filter(ManagedTask.ended == None)
+        .as_scalar())
+    unverified_phones = (db.session.query(db.func.count(Phone.id))
+        .filter(db.or_(Phone.verified == False, Phone.verified == None))
+        .as_scalar())
+    row = db.session.query(
+        active_alarms.label('active_alarms'),
+        pending_tasks.label('pending_tasks'),
+        unverified_phones.label('unverified_phones'),
+    ).one()
+    return {
+        'active_alarms': row.active_alarms,
+        'pending_tasks': row.pending_tasks,
+        'unverified_phones': row.unverified_phones,
+    }
+
+def stream_template(template_name, **context):
+    """Renders the template in chunks as the response body is written,
+    rather than building the whole page in memory first.
+    """
+    app.update_template_context(context)
+    template = app.jinja_env.get_template(template_name)
+    stream = template.stream(context)
+    stream.enable_buffering(20)
+    return stream
+
 @mod.route('/main')
 @admin_required
 def admin_panel():
-    logger.info("admin_panel request approved for user: {}".format(g.user))
-    return render_template('admin/main.html',
-        users=User.query.all(),
-        alarms=Alarm.query.all(),
-        phones=Phone.query.all(),
-        tasks=ManagedTask.query.all(),
-    )
+    logger.info("admin_panel request approved for user: %s", g.user)
+    section = request.args.get('section', 'users')
+    if section not in SECTIONS:
+        abort(404)
+    after = request.args.get('after', None, type=int)
+    rows, next_after = get_page(section, after,
+        size=app.config.get('ADMIN_PAGE_SIZE', 100))
+    local_times = {}
+    if section == 'alarms':
+        local_times = dict(zip([alarm.id for alarm in rows],
+            get_local_times([(alarm.time, alarm.owner.timezone)
+                for alarm in rows])))
+        local_times.update((alarm.id, alarm.local_time) for alarm in rows
+            if alarm.local_time is not None)
+    return Response(stream_with_context(stream_template('admin/main.html',
+        sections=SECTIONS,
+        section=section,
+        rows=rows,
+        after=after,
+        next_after=next_after,
+        local_times=local_times,
+        counters=get_counters(),
+    )))
 
+@mod.route('/metrics')
+@admin_required
+def metrics():
+    """Dispatch latency, throughput and failure figures for the last
+    METRICS_WINDOW_MINUTES of alarm steps, as plain text.
+    """
+    window = app.config.get('METRICS_WINDOW_MINUTES', 60)
+    body = DispatchMetrics(window_minutes=window).collect().render()
+    return Response(body, mimetype='text/plain')
@@ -2,57 +2,97 @@ from __future__ import absolute_import, division, print_function
 from datetime import datetime, timedelta
 import pytz
 
-from .. import db
+from .. import clock, db, timezones
+
+def next_fire_time(alarm_time, now):
+    """Returns the next naive utc datetime the given utc alarm time occurs
+    at, today if it is still ahead of now, otherwise tomorrow.
+    """
+    fire_time = now.replace(
+        hour=alarm_time.hour,
+        minute=alarm_time.minute,
+        second=0,
+        microsecond=0,
+        tzinfo=None,
+    )
+    if alarm_time <= now.time():
+        fire_time = fire_time + timedelta(days=1)
+    return fire_time
+
+def next_local_fire_time(local_time, tz, now):
+    """Returns the next naive utc datetime the given local wall clock time
+    occurs at in zone tz, so the alarm keeps ringing at the same local time
+    on either side of a DST transition.
+    """
+    local_now = timezones.to_local(now, tz)
+    fire_time = datetime.combine(local_now.date(),
+        local_time.replace(second=0, microsecond=0, tzinfo=None))
+    if fire_time <= local_now:
+        fire_time = fire_time + timedelta(days=1)
+    return timezones.to_utc(fire_time, tz)
+
+def next_alarm_fire_time(alarm_time, local_time, tz, now):
+    """Returns an alarm's next fire time, from its local wall clock time
+    when it has one and from its fixed utc time otherwise.
+    """
+    if local_time is not None and tz:
+        return next_local_fire_time(local_time, tz, now)
+    return next_fire_time(alarm_time, now)
 
 class Alarm(db.Model):
 
     __tablename__ = 'alarms'
     id = db.Column(db.Integer, primary_key=True)
     time = db.Column(db.Time(timezone=False))
+    local_time = db.Column(db.Time(timezone=False))
+    timezone = db.Column(db.String(50), index=True)
     active = db.Column(db.Boolean)
+    next_fire_at = db.Column(db.DateTime(timezone=False), index=True)
+    generation = db.Column(db.Integer, default=0)
+    last_acknowledged = db.Column(db.DateTime(timezone=False))
     created = db.Column(db.DateTime(timezone=False))
     owner_id = db.Column(db.Integer, db.ForeignKey('users.id'))
     owner = db.relationship('User',
         backref=db.backref('alarms', lazy='dynamic'))
-    phone_id = db.Column(db.Integer, db.ForeignKey('phones.id'))
+    phone_id = db.Column(db.Integer, db.ForeignKey('phones.id'), index=True)
     phone = db.relationship('Phone',
         backref=db.backref('alarms', lazy='dynamic'))
 
-    def __init__(self, time=None, owner=None, phone=None):
+    def __init__(self, time=None, owner=None, phone=None, local_time=None,
+            timezone=None):
         self.time = time.replace(second=0, microsecond=0, tzinfo=None)
+        if local_time is not None:
+            local_time = local_time.replace(second=0, microsecond=0,
+                tzinfo=None)
+        self.local_time = local_time
+        self.timezone = timezone
         self.owner = owner
         self.phone = phone
-        self.created = datetime.utcnow()
+        self.created = clock.utcnow()
         self.active = False
+        self.next_fire_at = None
+        self.generation = 0
+        self.last_acknowledged = None
+
+    def get_next_fire_time(self, now=None):
+        if now is None:
+            now = clock.utcnow()
+        return next_alarm_fire_time(self.time, self.local_time,
+            self.timezone, now)
 
     def get_local(self):
-        local_timezone = pytz.timezone(self.owner.timezone)
-        utc_timezone = pytz.utc
-        alarm_as_utc_datetime = datetime.utcnow().replace(
-            hour=self.time.hour,
-            minute=self.time.minute,
-            tzinfo=utc_timezone,
-        )
-        alarm_as_local_datetime = local_timezone.normalize(
-            alarm_as_utc_datetime)
-        return alarm_as_local_datetime.time()
+        if self.local_time is not None:
+            return self.local_time
+        return timezones.get_local_times([(self.time, self.owner.timezone)])[0]
 
     def getNextRunTime(self, local=False):
-        utc_now = datetime.utcnow().replace(
-            second=0,
-            microsecond=0,
-            tzinfo=pytz.utc,
-        )
-        alarm_time = utc_now.replace(
-            hour=self.time.hour,
-            minute=self.time.minute,
-        )
-        if alarm_time < utc_now:
-            alarm_time = alarm_time + timedelta(days=1)
+        alarm_time = self.next_fire_at
+        if alarm_time is None:
+            alarm_time = self.get_next_fire_time()
         if local:
-            owner_timezone = pytz.timezone(self.owner.timezone)
-            alarm_time = owner_timezone.normalize(alarm_time)
-        return alarm_time
+            return timezones.localize(alarm_time,
+                self.timezone or self.owner.timezone)
+        return alarm_time.replace(tzinfo=pytz.utc)
 
     def __repr__(self):
         return "<Alarm {}: {})>".format(self.id, self.time)
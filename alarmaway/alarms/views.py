@@ -37,7 +37,9 @@ def add():
         alarm = Alarm(
             time=utc_alarm_time,
             owner=user,
-            phone=alarm_phone
+            phone=alarm_phone,
+            local_time=form.alarm_time.data,
+            timezone=user.timezone,
         )
         db.session.add(alarm)
         try:
@@ -46,7 +48,7 @@ def add():
             #TODO Add correct exception handling
             flash("Could not add alarm, please try again.", 'error')
         else:
-            logger.info("New alarm created {}".format(alarm))
+            logger.info("New alarm created %s", alarm)
             task_manager.processSetAlarm(alarm)
             flash('Your alarm has been created and set', 'success')
             session.pop('firstalarm', None)
@@ -79,7 +81,7 @@ def remove(alarm_id):
 @mod.route('/update/<alarm_id>', methods=['GET', 'POST'])
 @login_required
 def update(alarm_id):
-    logger.info("Update alarm {} view called by user {}".format(alarm_id, g.user.id))
+    logger.info("Update alarm %s view called by user %s", alarm_id, g.user.id)
     return redirect(url_for('users.home'))
 
 @mod.route('/set/<alarm_id>')
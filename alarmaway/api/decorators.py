@@ -0,0 +1,10 @@
+from functools import wraps
+from flask import g, jsonify
+
+def api_login_required(f):
+    @wraps(f)
+    def decorated_function(*args, **kwargs):
+        if g.user is None:
+            return jsonify(error='login required'), 401
+        return f(*args, **kwargs)
+    return decorated_function
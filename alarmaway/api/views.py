@@ -0,0 +1,164 @@
+from __future__ import absolute_import, division, print_function
+import datetime
+import hashlib
+import json
+
+from flask import Blueprint, Response, g, request
+from sqlalchemy.exc import IntegrityError
+
+from .. import app, db, task_manager
+from ..alarms.models import Alarm
+from ..phones.models import Phone
+from ..timezones import get_local_times
+from ..utils import get_utc
+from .decorators import api_login_required
+
+mod = Blueprint('api', __name__, url_prefix='/api')
+import logging
+logger = logging.getLogger('alarmaway')
+
+def json_response(payload, status=200):
+    """Returns payload as compact json, tagged with an ETag of its content.
+    A request whose If-None-Match already holds that tag gets an empty 304.
+    """
+    body = json.dumps(payload, separators=(',', ':'), sort_keys=True)
+    response = Response(body, status=status, mimetype='application/json')
+    if status == 200:
+        response.set_etag(hashlib.md5(body).hexdigest())
+        response.make_conditional(request)
+    return response
+
+def json_error(message, status=400):
+    return json_response({'error': message}, status=status)
+
+def get_ids():
+    """Returns the list of integer ids posted as {"ids": [...]}, or None."""
+    payload = request.json or {}
+    ids = payload.get('ids')
+    if not isinstance(ids, list) or len(ids) > app.config.get(
+            'API_BATCH_LIMIT', 500):
+        return None
+    try:
+        return [int(a_id) for a_id in ids]
+    except (TypeError, ValueError):
+        return None
+
+def dump_alarms(alarms):
+    """Returns compact dicts for the alarms, converting their local times
+    in one batch.
+    """
+    local_times = get_local_times([
+        (alarm.time, alarm.timezone or g.user.timezone) for alarm in alarms])
+    return [
+        {
+            'id': alarm.id,
+            'time': (alarm.local_time or local_time).strftime('%H:%M'),
+            'active': bool(alarm.active),
+            'phone_id': alarm.phone_id,
+        }
+        for alarm, local_time in zip(alarms, local_times)
+    ]
+
+def get_owned_alarms(ids):
+    return (Alarm.query
+        .filter(Alarm.owner_id == g.user.id)
+        .filter(Alarm.id.in_(ids))
+        .all()) if ids else []
+
+def batch_result(done, ids):
+    done_ids = set(done)
+    return json_response({
+        'done': sorted(done_ids),
+        'skipped': [a_id for a_id in ids if a_id not in done_ids],
+    })
+
+@mod.route('/alarms', methods=['GET'])
+@api_login_required
+def list_alarms():
+    alarms = (Alarm.query
+        .filter(Alarm.owner_id == g.user.id)
+        .order_by(Alarm.id)
+        .all())
+    return json_response({'alarms': dump_alarms(alarms)})
+
+@mod.route('/alarms', methods=['POST'])
+@api_login_required
+def create_alarm():
+    """Creates an alarm from {"time": "HH:MM", "phone_id": id, "set": bool},
+    the time being local to the user.
+    """
+    payload = request.json or {}
+    try:
+        local_time = datetime.datetime.strptime(
+            payload.get('time', ''), '%H:%M').time()
+    except (TypeError, ValueError):
+        return json_error('time must be HH:MM')
+    phone = Phone.query.filter_by(
+        id=payload.get('phone_id'),
+        owner_id=g.user.id,
+    ).first()
+    if phone is None:
+        return json_error('unknown phone', status=404)
+
+    alarm = Alarm(
+        time=get_utc(local_time, g.user.timezone),
+        owner=g.user,
+        phone=phone,
+        local_time=local_time,
+        timezone=g.user.timezone,
+    )
+    db.session.add(alarm)
+    try:
+        db.session.commit()
+    except IntegrityError:
+        db.session.rollback()
+        return json_error('could not add alarm', status=409)
+    logger.info("New alarm created through the api %s", alarm)
+    if payload.get('set', True):
+        task_manager.processSetAlarm(alarm)
+    return json_response({'alarm': dump_alarms([alarm])[0]}, status=201)
+
+@mod.route('/alarms/set', methods=['POST'])
+@api_login_required
+def set_alarms():
+    ids = get_ids()
+    if ids is None:
+        return json_error('ids must be a list of alarm ids')
+    alarms = [alarm for alarm in get_owned_alarms(ids) if not alarm.active]
+    task_manager.processSetAlarms(alarms)
+    return batch_result([alarm.id for alarm in alarms], ids)
+
+@mod.route('/alarms/unset', methods=['POST'])
+@api_login_required
+def unset_alarms():
+    ids = get_ids()
+    if ids is None:
+        return json_error('ids must be a list of alarm ids')
+    done = [alarm.id for alarm in get_owned_alarms(ids) if alarm.active]
+    task_manager.processUnsetAlarms(done)
+    return batch_result(done, ids)
+
+@mod.route('/alarms/remove', methods=['POST'])
+@api_login_required
+def remove_alarms():
+    """Removes the given alarms. As with the alarms views, alarms that are
+    still set are skipped.
+    """
+    ids = get_ids()
+    if ids is None:
+        return json_error('ids must be a list of alarm ids')
+    done = [alarm.id for alarm in get_owned_alarms(ids) if not alarm.active]
+    task_manager.processRemoveAlarms(done)
+    return batch_result(done, ids)
+
+@mod.route('/phones', methods=['GET'])
+@api_login_required
+def list_phones():
+    phones = (Phone.query
+        .filter(Phone.owner_id == g.user.id)
+        .order_by(Phone.id)
+        .all())
+    return json_response({'phones': [
+        {'id': phone.id, 'number': phone.number, 'verified': bool(phone.verified)}
+        for phone in phones
+    ]})
@@ -1,9 +1,35 @@
 from __future__ import absolute_import
 
+from datetime import timedelta
+
 from celery import Celery
 
 celery = Celery('alarmaway.celery', include=['alarmaway.celery.tasks'],)
 celery.config_from_object('celeryconfig')
 
+# Housekeeping tasks run by celery beat. Entries in celeryconfig win.
+beat_schedule = celery.conf.setdefault('CELERYBEAT_SCHEDULE', {})
+beat_schedule.setdefault('advance-fired-alarms', {
+    'task': 'alarmaway.celery.tasks.advance_fired_alarms',
+    'schedule': timedelta(minutes=1),
+})
+beat_schedule.setdefault('rearm-alarms', {
+    'task': 'alarmaway.celery.tasks.rearm_alarms',
+    'schedule': timedelta(minutes=5),
+})
+beat_schedule.setdefault('flush-email-queue', {
+    'task': 'alarmaway.celery.tasks.flush_email_queue',
+    'schedule': timedelta(
+        seconds=celery.conf.get('EMAIL_FLUSH_INTERVAL', 10)),
+})
+beat_schedule.setdefault('reschedule-dst-alarms', {
+    'task': 'alarmaway.celery.tasks.reschedule_dst_alarms',
+    'schedule': timedelta(hours=1),
+})
+beat_schedule.setdefault('compact-task-history', {
+    'task': 'alarmaway.celery.tasks.compact_task_history',
+    'schedule': timedelta(hours=1),
+})
+
 if __name__ == '__main__':
     celery.start()
@@ -0,0 +1,37 @@
+# Managed task actions
+CALL = 'call'
+SMS = 'sms'
+ACTION = {
+    CALL: 'Phone call',
+    SMS: 'SMS message',
+}
+
+# Managed task outcomes
+SENT = 'sent'
+FAILED = 'failed'
+EXPIRED = 'expired'
+CANCELLED = 'cancelled'
+ACKNOWLEDGED = 'acknowledged'
+RESCHEDULED = 'rescheduled'
+OUTCOME = {
+    SENT: 'Sent',
+    FAILED: 'Failed',
+    EXPIRED: 'Expired',
+    CANCELLED: 'Cancelled',
+    ACKNOWLEDGED: 'Acknowledged',
+    RESCHEDULED: 'Rescheduled',
+}
+
+# Send priorities, lower numbers are served first
+PRIORITY_CALL = 0
+PRIORITY_FOLLOWUP = 1
+PRIORITY_MESSAGE = 2
+PRIORITY = {
+    PRIORITY_CALL: 'Alarm call',
+    PRIORITY_FOLLOWUP: 'Alarm follow-up',
+    PRIORITY_MESSAGE: 'Account message',
+}
+
+# Rate limited providers
+TWILIO = 'twilio'
+SMTP = 'smtp'
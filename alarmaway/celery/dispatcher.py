@@ -0,0 +1,128 @@
+from __future__ import absolute_import
+import datetime
+
+from .. import app, clock, db, task_manager
+from ..alarms.models import Alarm
+from . import constants as TASK
+from .celery import celery
+from .models import ManagedTask
+from . import tasks
+from .task_manager import get_step_job
+from .tasks import STEP_EXPIRY
+
+import logging
+logger = logging.getLogger('alarmaway')
+
+def floor_minute(dt):
+    return dt.replace(second=0, microsecond=0, tzinfo=None)
+
+def chunks(items, size):
+    for start in range(0, len(items), size):
+        yield items[start:start + size]
+
+
+class Dispatcher(object):
+    """Publishes alarm steps to celery only once they are due.
+
+    ManagedTask rows with an eta but no celery task_id are the durable
+    record of what still has to be sent. Every tick reads the ones due by
+    then off the eta index, so a row that was committed late, whatever its
+    id, is still published on the next tick.
+    """
+
+    def __init__(self, db, batch_size=None):
+        self.db = db
+        self.batch_size = batch_size or app.config.get(
+            'DISPATCHER_BATCH_SIZE', 500)
+        self.send_batch_size = app.config.get('SEND_BATCH_SIZE', 100)
+
+    def load(self, now):
+        """Returns the ids of the unpublished steps due by the end of now's
+        minute. Steps more than STEP_EXPIRY overdue are left to the expiry
+        sweep, which keeps the index range read here short.
+        """
+        now = floor_minute(now)
+        return [m_id for m_id, in self.db.session.query(ManagedTask.id)
+            .filter(ManagedTask.eta >= now - STEP_EXPIRY)
+            .filter(ManagedTask.eta < now + datetime.timedelta(minutes=1))
+            .filter(ManagedTask.task_id == None)
+            .filter(ManagedTask.ended == None)
+            .order_by(ManagedTask.eta, ManagedTask.id)]
+
+    def tick(self, now=None):
+        """Publishes every step due by now as send_batch tasks. Returns the
+        number of steps published.
+        """
+        if now is None:
+            now = clock.utcnow()
+        now = floor_minute(now)
+        published = 0
+        for batch in chunks(self.load(now), self.batch_size):
+            published += self.publish(batch, now)
+        task_manager.processFiredAlarms(now)
+        return published
+
+    def publish(self, ids, now):
+        rows = (self.db.session.query(
+                ManagedTask.id,
+                ManagedTask.action,
+                ManagedTask.eta,
+                ManagedTask.generation,
+                Alarm.id,
+                Alarm.phone_id,
+                Alarm.generation,
+            )
+            .join(Alarm, ManagedTask.alarm_id == Alarm.id)
+            .filter(ManagedTask.id.in_(ids))
+            .filter(ManagedTask.task_id == None)
+            .filter(ManagedTask.ended == None)
+            .all())
+
+        jobs, expired = [], []
+        for (m_id, action, eta, generation,
+                alarm_id, phone_id, current) in rows:
+            if eta + STEP_EXPIRY < now or generation != current:
+                expired.append(m_id)
+            else:
+                jobs.append(get_step_job(
+                    m_id, action, phone_id, alarm_id, generation, eta))
+
+        table = ManagedTask.__table__
+        with celery.producer_or_acquire() as producer:
+            for batch in chunks(jobs, self.send_batch_size):
+                async_task = tasks.send_batch.apply_async(
+                    args=(batch,),
+                    expires=now+STEP_EXPIRY,
+                    producer=producer,
+                )
+                self.db.session.execute(
+                    table.update()
+                        .where(table.c.id.in_([job['m_id'] for job in batch]))
+                        .values(task_id=async_task.id)
+                )
+        if expired:
+            self.db.session.execute(
+                table.update()
+                    .where(table.c.id.in_(expired))
+                    .values(ended=now, outcome=TASK.EXPIRED),
+            )
+        self.db.session.commit()
+        logger.info("dispatcher published %s steps, expired %s",
+            len(jobs), len(expired))
+        return len(jobs)
+
+    def run(self):
+        logger.info("dispatcher starting")
+        while True:
+            try:
+                self.tick()
+            except Exception:
+                logger.exception("dispatcher tick failed")
+                self.db.session.rollback()
+            now = clock.utcnow()
+            next_minute = floor_minute(now) + datetime.timedelta(minutes=1)
+            clock.sleep((next_minute - now).total_seconds())
+
+
+if __name__ == '__main__':
+    Dispatcher(db).run()
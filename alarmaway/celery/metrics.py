@@ -0,0 +1,123 @@
+from __future__ import absolute_import, division
+from bisect import bisect_left
+from collections import defaultdict
+import datetime
+
+from .. import clock, db
+from . import constants as TASK
+from .models import ManagedTask
+
+# Upper bounds, in seconds, of the lateness histogram buckets.
+LATENESS_BUCKETS = (0.5, 1, 2, 5, 10, 15, 30, 60, 120, 300, 600,
+    float('inf'))
+
+ACTION_PROVIDER = {
+    TASK.CALL: TASK.TWILIO,
+    TASK.SMS: TASK.TWILIO,
+}
+
+def seconds_between(start, end):
+    return (end - start).total_seconds()
+
+class Histogram(object):
+    """A fixed bucket histogram. Memory stays constant however many values
+    are observed; quantiles are interpolated within their bucket.
+    """
+
+    def __init__(self, bounds=LATENESS_BUCKETS):
+        self.bounds = bounds
+        self.counts = [0] * len(bounds)
+        self.count = 0
+        self.total = 0.0
+
+    def observe(self, value):
+        value = max(value, 0)
+        self.counts[bisect_left(self.bounds, value)] += 1
+        self.count += 1
+        self.total += value
+
+    def quantile(self, q):
+        if not self.count:
+            return 0.0
+        rank = q * self.count
+        seen = 0
+        for index, count in enumerate(self.counts):
+            if count and seen + count >= rank:
+                lower = self.bounds[index - 1] if index else 0.0
+                upper = self.bounds[index]
+                if upper == float('inf'):
+                    return lower
+                return lower + (upper - lower) * (rank - seen) / count
+            seen += count
+        return self.bounds[-2]
+
+
+class DispatchMetrics(object):
+    """Lateness, throughput and failure figures for alarm steps whose eta
+    falls within a window, built from the timestamps the send tasks record
+    on each ManagedTask.
+    """
+
+    def __init__(self, window_minutes=60):
+        self.window_minutes = window_minutes
+        self.lateness = Histogram()
+        self.pickup = Histogram()
+        self.sent_per_minute = defaultdict(int)
+        self.failures = defaultdict(int)
+        self.outcomes = defaultdict(int)
+
+    def observe(self, action, eta, picked_up, accepted, outcome):
+        provider = ACTION_PROVIDER.get(action, TASK.TWILIO)
+        self.outcomes[outcome] += 1
+        if picked_up is not None:
+            self.pickup.observe(seconds_between(eta, picked_up))
+        if outcome == TASK.FAILED:
+            self.failures[provider] += 1
+        if accepted is not None:
+            self.lateness.observe(seconds_between(eta, accepted))
+            self.sent_per_minute[accepted.replace(second=0, microsecond=0)] += 1
+
+    def collect(self, now=None):
+        """Feeds every step due in the window into the histograms, streaming
+        the rows rather than loading them all.
+        """
+        if now is None:
+            now = clock.utcnow()
+        since = now - datetime.timedelta(minutes=self.window_minutes)
+        rows = (db.session.query(
+                ManagedTask.action,
+                ManagedTask.eta,
+                ManagedTask.picked_up,
+                ManagedTask.accepted,
+                ManagedTask.outcome,
+            )
+            .filter(ManagedTask.eta >= since)
+            .filter(ManagedTask.eta < now)
+            .yield_per(1000))
+        for action, eta, picked_up, accepted, outcome in rows:
+            self.observe(action, eta, picked_up, accepted, outcome)
+        return self
+
+    def render(self):
+        """Returns the figures as 'name{labels} value' text lines."""
+        lines = []
+        for name, histogram in (('send_lateness_seconds', self.lateness),
+                ('pickup_lag_seconds', self.pickup)):
+            for q in (0.5, 0.95, 0.99):
+                lines.append('alarmaway_{}{{quantile="{}"}} {:.3f}'.format(
+                    name, q, histogram.quantile(q)))
+            lines.append('alarmaway_{}_count {}'.format(name, histogram.count))
+            lines.append('alarmaway_{}_sum {:.3f}'.format(name, histogram.total))
+        per_minute = self.sent_per_minute.values()
+        lines.append('alarmaway_sent_per_minute_max {}'.format(
+            max(per_minute) if per_minute else 0))
+        lines.append('alarmaway_sent_per_minute_mean {:.2f}'.format(
+            sum(per_minute) / self.window_minutes))
+        for provider in sorted(set(ACTION_PROVIDER.values())):
+            lines.append('alarmaway_send_failures{{provider="{}"}} {}'.format(
+                provider, self.failures[provider]))
+        for outcome in sorted(self.outcomes, key=str):
+            lines.append('alarmaway_steps{{outcome="{}"}} {}'.format(
+                outcome if outcome is not None else 'pending',
+                self.outcomes[outcome]))
+        return '\n'.join(lines) + '\n'
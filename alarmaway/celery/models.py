@@ -1,5 +1,4 @@
-from datetime import datetime
-from .. import db
+from .. import clock, db
 
 import logging
 logger = logging.getLogger("alarmaway")
@@ -10,12 +9,18 @@ class ManagedTask(db.Model):
     return_id = db.Column(db.String(70))
     started = db.Column(db.DateTime(timezone=False))
     ended = db.Column(db.DateTime(timezone=False))
-    alarm_id = db.Column(db.Integer, db.ForeignKey('alarms.id'))
+    alarm_id = db.Column(db.Integer, db.ForeignKey('alarms.id'), index=True)
     alarm = db.relationship('Alarm')
-    phone_id = db.Column(db.Integer, db.ForeignKey('phones.id'))
+    phone_id = db.Column(db.Integer, db.ForeignKey('phones.id'), index=True)
     phone = db.relationship('Phone')
     user_id = db.Column(db.Integer, db.ForeignKey('users.id'))
     user = db.relationship('User')
+    eta = db.Column(db.DateTime(timezone=False), index=True)
+    action = db.Column(db.String(20))
+    generation = db.Column(db.Integer)
+    outcome = db.Column(db.String(20))
+    picked_up = db.Column(db.DateTime(timezone=False))
+    accepted = db.Column(db.DateTime(timezone=False))
 
     def __init__(self,
             task_id=None,
@@ -23,15 +28,116 @@ class ManagedTask(db.Model):
             alarm=None,
             phone=None,
             user=None,
+            eta=None,
+            action=None,
+            generation=None,
             ):
         self.task_id = task_id
         self.return_id = return_id
         self.alarm = alarm
         self.phone = phone
         self.user = user
-        self.started = datetime.utcnow().replace(second=0, microsecond=0, tzinfo=None)
+        self.eta = eta
+        self.action = action
+        self.generation = generation
+        self.started = clock.utcnow().replace(second=0, microsecond=0, tzinfo=None)
         self.ended = None
+        self.outcome = None
+        self.picked_up = None
+        self.accepted = None
 
-    def finish(self):
-        logger.info("task {} finishing self.".format(self.id))
-        self.ended = datetime.utcnow().replace(second=0, microsecond=0, tzinfo=None)
+    def finish(self, outcome=None):
+        logger.info("task %s finishing self.", self.id)
+        self.ended = clock.utcnow().replace(second=0, microsecond=0, tzinfo=None)
+        self.outcome = outcome
+
+
+class TaskHistory(db.Model):
+    """Daily per-alarm rollup of finished ManagedTasks, counted by action
+    and outcome, so old tasks can leave the managed_task table.
+    """
+
+    __tablename__ = 'task_history'
+    __table_args__ = (
+        db.UniqueConstraint('alarm_id', 'day', 'action', 'outcome'),
+    )
+    id = db.Column(db.Integer, primary_key=True)
+    alarm_id = db.Column(db.Integer, db.ForeignKey('alarms.id'), index=True)
+    alarm = db.relationship('Alarm')
+    day = db.Column(db.Date)
+    action = db.Column(db.String(20))
+    outcome = db.Column(db.String(20))
+    count = db.Column(db.Integer, default=0)
+
+    def __init__(self, alarm_id=None, day=None, action=None, outcome=None,
+            count=0):
+        self.alarm_id = alarm_id
+        self.day = day
+        self.action = action
+        self.outcome = outcome
+        self.count = count
+
+    def __repr__(self):
+        return "<TaskHistory {}: alarm {} {} {} {}x{}>".format(
+            self.id, self.alarm_id, self.day, self.action, self.outcome,
+            self.count)
+
+
+class RateBucket(db.Model):
+    """Shared token bucket state for a rate limited provider. See
+    alarmaway.celery.ratelimit.
+    """
+
+    __tablename__ = 'rate_buckets'
+    name = db.Column(db.String(20), primary_key=True)
+    tokens = db.Column(db.Float)
+    updated = db.Column(db.Float)
+    starved_priority = db.Column(db.SmallInteger)
+    starved_at = db.Column(db.Float)
+
+    def __init__(self, name, tokens=0.0, updated=0.0):
+        self.name = name
+        self.tokens = tokens
+        self.updated = updated
+        self.starved_priority = None
+        self.starved_at = None
+
+    def __repr__(self):
+        return "<RateBucket {}: {:.1f}>".format(self.name, self.tokens)
+
+
+class QueuedEmail(db.Model):
+    """An email waiting for the next batched flush of the email queue."""
+
+    __tablename__ = 'queued_emails'
+    id = db.Column(db.Integer, primary_key=True)
+    subject = db.Column(db.String(200))
+    recipients = db.Column(db.Text)
+    sender = db.Column(db.String(120))
+    body_text = db.Column(db.Text)
+    body_html = db.Column(db.Text)
+    created = db.Column(db.DateTime(timezone=False))
+    attempts = db.Column(db.SmallInteger, default=0)
+    user_id = db.Column(db.Integer, db.ForeignKey('users.id'))
+    user = db.relationship('User')
+
+    def __init__(self, subject, recipients,
+            sender=None,
+            body_text=None,
+            body_html=None,
+            user=None,
+            ):
+        self.subject = subject
+        self.recipients = ','.join(recipients)
+        self.sender = sender
+        self.body_text = body_text
+        self.body_html = body_html
+        self.user = user
+        self.created = clock.utcnow()
+        self.attempts = 0
+
+    def getRecipients(self):
+        return self.recipients.split(',') if self.recipients else []
+
+    def __repr__(self):
+        return "<QueuedEmail {}: {}>".format(self.id, self.subject)
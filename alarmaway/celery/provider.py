@@ -0,0 +1,75 @@
+from __future__ import absolute_import
+import os
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from .. import app
+from .config import TWILIO_ACCOUNT_ID, TWILIO_SECRET_TOKEN
+
+TWILIO_API_BASE = 'https://api.twilio.com/2010-04-01'
+
+class TwilioClient(object):
+    """A small client for the two Twilio REST resources we use.
+
+    TwilioRestClient opens a fresh connection (and TLS handshake) for every
+    request, so this talks to the REST API through a requests session whose
+    connection pool keeps connections alive between sends.
+    """
+
+    def __init__(self, account, token,
+            base_url=TWILIO_API_BASE,
+            pool_size=10,
+            connect_timeout=3.05,
+            read_timeout=10,
+            ):
+        self.account_url = '{}/Accounts/{}'.format(base_url, account)
+        self.timeout = (connect_timeout, read_timeout)
+        self.session = requests.Session()
+        self.session.auth = (account, token)
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
+
+    def _post(self, resource, data):
+        response = self.session.post(
+            '{}/{}.json'.format(self.account_url, resource),
+            data=data,
+            timeout=self.timeout,
+        )
+        response.raise_for_status()
+        return response.json()
+
+    def send_sms(self, to, from_, body):
+        return self._post('SMS/Messages', {
+            'To': to,
+            'From': from_,
+            'Body': body,
+        })
+
+    def make_call(self, to, from_, url):
+        return self._post('Calls', {
+            'To': to,
+            'From': from_,
+            'Url': url,
+        })
+
+_client = None
+_client_pid = None
+
+def get_client():
+    """Returns this process's Twilio client. It is created lazily and again
+    after a fork, so prefork workers never share a connection pool.
+    """
+    global _client, _client_pid
+    if _client is None or _client_pid != os.getpid():
+        _client = TwilioClient(
+            TWILIO_ACCOUNT_ID,
+            TWILIO_SECRET_TOKEN,
+            base_url=app.config.get('TWILIO_API_BASE', TWILIO_API_BASE),
+            pool_size=app.config.get('TWILIO_POOL_SIZE', 10),
+            connect_timeout=app.config.get('TWILIO_CONNECT_TIMEOUT', 3.05),
+            read_timeout=app.config.get('TWILIO_READ_TIMEOUT', 10),
+        )
+        _client_pid = os.getpid()
+    return _client
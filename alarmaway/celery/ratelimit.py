@@ -0,0 +1,159 @@
+from __future__ import absolute_import
+import threading
+
+from sqlalchemy.exc import IntegrityError
+
+from .. import app, clock, db
+from . import constants as TASK
+from .models import RateBucket
+
+import logging
+logger = logging.getLogger('alarmaway')
+
+DEFAULT_RATE_LIMITS = {
+    TASK.TWILIO: (10.0, 20.0),
+    TASK.SMTP: (5.0, 10.0),
+}
+
+class BucketState(object):
+    """In-memory counterpart of a RateBucket row."""
+
+    def __init__(self, name, tokens=0.0, updated=0.0):
+        self.name = name
+        self.tokens = tokens
+        self.updated = updated
+        self.starved_priority = None
+        self.starved_at = None
+
+
+class MemoryBackend(object):
+    """Keeps bucket state in this process only. Suitable for a single
+    worker, tests and simulations.
+    """
+
+    def __init__(self):
+        self.buckets = {}
+        self.lock = threading.Lock()
+
+    def transact(self, name, capacity, now, func):
+        with self.lock:
+            state = self.buckets.get(name)
+            if state is None:
+                state = self.buckets[name] = BucketState(name, capacity, now)
+            return func(state)
+
+
+class DatabaseBackend(object):
+    """Shares bucket state across workers through the rate_buckets table,
+    holding a row lock for the duration of each update.
+    """
+
+    def __init__(self, db):
+        self.db = db
+
+    def transact(self, name, capacity, now, func):
+        bucket = (RateBucket.query
+            .with_lockmode('update')
+            .filter_by(name=name)
+            .first())
+        if bucket is None:
+            self.db.session.add(RateBucket(name, capacity, now))
+            try:
+                self.db.session.commit()
+            except IntegrityError:
+                self.db.session.rollback()
+            return self.transact(name, capacity, now, func)
+        try:
+            result = func(bucket)
+            self.db.session.commit()
+        except:
+            self.db.session.rollback()
+            raise
+        return result
+
+
+class RateLimiter(object):
+    """Token buckets per provider with strict priority between senders.
+
+    Each provider refills at rate tokens a second up to capacity. When a
+    sender is refused for lack of tokens the bucket remembers its priority
+    for starve_window seconds, and lower priority senders are refused
+    during that time, so first attempt calls always beat follow-up sms,
+    which beat account messages.
+    """
+
+    def __init__(self, backend, limits=None, starve_window=1.0):
+        self.backend = backend
+        self.limits = limits if limits is not None else DEFAULT_RATE_LIMITS
+        self.starve_window = starve_window
+
+    def acquire(self, name, priority, now=None):
+        """Takes a token for a send at the given priority. Returns 0 when
+        the send may go ahead, otherwise the seconds to wait before trying
+        again.
+        """
+        granted, wait = self._take(name, priority, 1, now)
+        return 0 if granted else wait
+
+    def acquire_up_to(self, name, priority, count, now=None):
+        """Takes as many tokens as are available, up to count, in one go.
+        Returns the number granted.
+        """
+        granted, _ = self._take(name, priority, count, now)
+        return granted
+
+    def acquire_many(self, name, priority, count, now=None):
+        """Takes as many tokens as are available, up to count, in one go.
+        Returns the number granted and, when that falls short of count, the
+        seconds to wait before trying again for the rest.
+        """
+        granted, wait = self._take(name, priority, count, now)
+        if granted < count and not wait:
+            wait = (count - granted) / float(self.limits[name][0])
+        return granted, wait
+
+    def _take(self, name, priority, count, now):
+        if name not in self.limits:
+            return count, 0
+        rate, capacity = self.limits[name]
+        if now is None:
+            now = clock.time()
+
+        def take(bucket):
+            elapsed = max(0, now - bucket.updated)
+            bucket.tokens = min(capacity, bucket.tokens + elapsed * rate)
+            bucket.updated = max(now, bucket.updated)
+            starved = (bucket.starved_priority is not None
+                and now - bucket.starved_at < self.starve_window)
+            if starved and bucket.starved_priority < priority:
+                return 0, self.starve_window - (now - bucket.starved_at)
+            if bucket.tokens >= 1:
+                granted = min(count, int(bucket.tokens))
+                bucket.tokens -= granted
+                if starved and bucket.starved_priority == priority:
+                    bucket.starved_priority = None
+                return granted, 0
+            if not starved or priority <= bucket.starved_priority:
+                bucket.starved_priority = priority
+                bucket.starved_at = now
+            return 0, (1 - bucket.tokens) / rate
+
+        return self.backend.transact(name, capacity, now, take)
+
+_limiter = None
+
+def get_limiter():
+    """Returns the process wide limiter configured by RATE_LIMITS and
+    RATE_LIMIT_BACKEND ('database' or 'memory').
+    """
+    global _limiter
+    if _limiter is None:
+        if app.config.get('RATE_LIMIT_BACKEND', 'database') == 'memory':
+            backend = MemoryBackend()
+        else:
+            backend = DatabaseBackend(db)
+        _limiter = RateLimiter(
+            backend,
+            limits=app.config.get('RATE_LIMITS', DEFAULT_RATE_LIMITS),
+        )
+    return _limiter
@@ -1,35 +1,33 @@
 from __future__ import absolute_import
+import calendar
+from collections import defaultdict, namedtuple
 import datetime
 
+from celery.utils import uuid
+from sqlalchemy.sql import bindparam, or_, select
+
+from .. import clock, emails, timezones
+from . import constants as TASK
 from . import tasks
+from .tasks import STEP_EXPIRY
 from .celery import celery
-from .models import ManagedTask
+from .models import ManagedTask, QueuedEmail, TaskHistory
+from ..alarms.models import Alarm, next_alarm_fire_time
+from ..phones.models import Phone
+from ..responses.models import InboundMessage
+from ..users.cache import user_cache
 from ..users.models import User
 
 import logging
 logger = logging.getLogger('alarmaway')
 
-def get_alarm_schedule(alarm):
-    """Returns a list of datetimes as a "schedule" for the given alarm."""
-
-    now = datetime.datetime.utcnow().replace(tzinfo=None)
-    if alarm.time > now.time():
-        base_time = now.replace(
-            hour=alarm.time.hour,
-            minute=alarm.time.minute,
-            second=0,
-            microsecond=0,
-            tzinfo=None,
-            )
-    else:
-        now_tomorrow = now + datetime.timedelta(days=1)
-        base_time = now_tomorrow.replace(
-            hour=alarm.time.hour,
-            minute=alarm.time.minute,
-            second=0,
-            microsecond=0,
-            tzinfo=None,
-            )
+def get_alarm_schedule(alarm, base_time=None):
+    """Returns a list of datetimes as a "schedule" for the given alarm,
+    starting at base_time or else the alarm's next occurrence.
+    """
+
+    if base_time is None:
+        base_time = alarm.get_next_fire_time()
 
     #This can probably be done a little nicer/more programatically.
     times = [
@@ -42,135 +40,613 @@ def get_alarm_schedule(alarm):
         ]
     return times
 
+REMINDER_MESSAGE = 'Are you up yet?'
+
+VERIFICATION_MESSAGE = (
+    "Welcome to AlarmAway! Verify this phone using the verification "
+    "following verification code: {}"
+)
+
+def get_alarm_steps(alarm, base_time=None):
+    """Returns the alarm's schedule as a list of (datetime, action) pairs,
+    alternating between phone calls and sms reminders.
+    """
+    return [
+        (time, TASK.CALL if count % 2 == 0 else TASK.SMS)
+        for count, time in enumerate(get_alarm_schedule(alarm, base_time))
+    ]
+
+def get_step_task(action, phone_id, alarm_id, generation, m_id):
+    """Returns the celery task, args and kwargs used to perform an alarm step.
+    The alarm's generation travels with the step so that the worker can
+    drop it if the alarm has been unset or responded to since, and the id
+    of its ManagedTask so the worker can record how the send went.
+    """
+    kwargs = dict(alarm_id=alarm_id, generation=generation, m_id=m_id)
+    if action == TASK.SMS:
+        return tasks.send_sms_message, (phone_id, REMINDER_MESSAGE), kwargs
+    return tasks.send_phone_call, (phone_id,), kwargs
+
+def get_step_job(m_id, action, phone_id, alarm_id, generation, eta):
+    """Returns an alarm step as a job for the send_batch task. The utc eta
+    travels as epoch seconds, so jobs survive the json serializer.
+    """
+    job = dict(
+        m_id=m_id,
+        action=action,
+        phone_id=phone_id,
+        alarm_id=alarm_id,
+        generation=generation,
+        eta=calendar.timegm(eta.utctimetuple()) if eta is not None else None,
+    )
+    if action == TASK.SMS:
+        job['message'] = REMINDER_MESSAGE
+    return job
+
+# The alarm columns scheduling reads, taken off the ORM objects once so that
+# commits between batches do not send them back to the database.
+AlarmState = namedtuple('AlarmState', [
+    'id', 'phone_id', 'generation', 'time', 'local_time', 'timezone',
+    'next_fire_at',
+])
+
+def get_alarm_state(alarm):
+    return AlarmState(alarm.id, alarm.phone_id, alarm.generation, alarm.time,
+        alarm.local_time, alarm.timezone, alarm.next_fire_at)
+
 class TaskManager:
-    def __init__(self, db=None):
+    def __init__(self, db=None, app=None):
+        self.use_dispatcher = False
+        self.batch_size = 500
+        self.task_retention = datetime.timedelta(hours=48)
+        self.dst_lookahead = datetime.timedelta(hours=24)
         if db is not None:
             self.db = db
+        if app is not None:
+            self.init_app(app)
 
     def init_db(self, db):
         self.db = db
 
+    def init_app(self, app):
+        """When USE_ALARM_DISPATCHER is set, alarm steps are only recorded
+        as ManagedTasks and the dispatcher process publishes them when due,
+        instead of each one sitting in a worker's memory as an eta task.
+        """
+        self.use_dispatcher = app.config.get('USE_ALARM_DISPATCHER', False)
+        self.batch_size = app.config.get('ALARM_BATCH_SIZE', 500)
+        self.task_retention = datetime.timedelta(
+            hours=app.config.get('TASK_RETENTION_HOURS', 48))
+        self.dst_lookahead = datetime.timedelta(
+            hours=app.config.get('DST_LOOKAHEAD_HOURS', 24))
+
     def test_db(self, email=None):
         user = User.query.filter_by(email=email).first()
         tasks.greet(user.name, user.id)
 
     def processPhoneVerification(self, phone, verification_code):
-        message = (
-            "Welcome to AlarmAway! Verify this phone using the verification "
-            "following verification code: {}"
-            .format(verification_code)
-            )
-        async = tasks.send_sms_message.apply_async(
-            args=(phone.id, message),)
-        task = ManagedTask(task_id=async.id, phone=phone)
-        self.db.session.add(task)
+        self.processPhoneVerifications([(phone.id, verification_code)])
+
+    def processPhoneVerifications(self, codes):
+        """Sends each (phone id, verification code) pair its verification
+        sms, recording their ManagedTasks with one bulk insert and
+        publishing them all through one producer. Each sms carries its
+        ManagedTask id, so the worker ends the task once it is sent.
+        """
+        codes = list(codes)
+        if not codes:
+            return
+        now = clock.utcnow().replace(second=0, microsecond=0)
+        task_ids = [uuid() for _ in codes]
+        self.db.session.execute(ManagedTask.__table__.insert(), [
+            {
+                'task_id': task_id,
+                'phone_id': phone_id,
+                'started': now,
+                'ended': None,
+            }
+            for task_id, (phone_id, _) in zip(task_ids, codes)
+        ])
+        m_ids = dict(self.db.session.query(ManagedTask.task_id, ManagedTask.id)
+            .filter(ManagedTask.phone_id.in_(
+                set(phone_id for phone_id, _ in codes)))
+            .filter(ManagedTask.ended == None))
+        # The sms go out straight away, so their rows must be visible first.
         self.db.session.commit()
-        logger.info(
-            "processPhoneVerification successful - phone: {}, task: {}".format(
-                phone, task
-        ))
+        with celery.producer_or_acquire() as producer:
+            for task_id, (phone_id, verification_code) in zip(task_ids, codes):
+                tasks.send_sms_message.apply_async(
+                    args=(phone_id, VERIFICATION_MESSAGE.format(
+                        verification_code)),
+                    kwargs=dict(m_id=m_ids[task_id]),
+                    task_id=task_id,
+                    producer=producer,
+                )
+        logger.info("processPhoneVerifications successful - phones: %s",
+            [phone_id for phone_id, _ in codes])
 
     def processSetAlarm(self, alarm):
-        for count, time in enumerate(get_alarm_schedule(alarm)):
-            if count % 2 != 0:
-                async_task = tasks.send_sms_message.apply_async(
-                    args=(alarm.phone.id, 'Are you up yet?'),
-                    eta=time,
-                    expires=time+datetime.timedelta(seconds=120),
-                )
-            else:
-                async_task = tasks.send_phone_call.apply_async(
-                    args=(alarm.phone.id,),
-                    eta=time,
-                    expires=time+datetime.timedelta(seconds=120),
+        self.processSetAlarms([alarm])
+
+    def processSetAlarms(self, alarms):
+        """Sets many alarms at once. Each batch of alarms has all of its
+        steps published through one producer and recorded with one bulk
+        insert, rather than a broker round trip and commit per step.
+        """
+        now = clock.utcnow().replace(second=0, microsecond=0)
+        alarms = [get_alarm_state(alarm) for alarm in alarms]
+        for start in range(0, len(alarms), self.batch_size):
+            self._queueAlarmSteps(alarms[start:start + self.batch_size], now)
+        logger.info("processSetAlarms successful - alarms: %s",
+            [alarm.id for alarm in alarms])
+
+    def processUnsetAlarm(self, alarm):
+        self.processUnsetAlarms([alarm.id])
+
+    def processUnsetAlarms(self, alarm_ids):
+        """Turns the alarms off. Rather than revoking each pending step, the
+        alarms' generation is bumped so workers skip the stale steps.
+        """
+        alarm_ids = list(alarm_ids)
+        if not alarm_ids:
+            return
+        self._cancelPendingSteps(alarm_ids, TASK.CANCELLED)
+        table = Alarm.__table__
+        self.db.session.execute(
+            table.update()
+                .where(table.c.id.in_(alarm_ids))
+                .values(
+                    generation=table.c.generation + 1,
+                    active=False,
+                    next_fire_at=None,
                 )
+        )
+        self.db.session.commit()
+        logger.info("processUnsetAlarms successful - alarms: %s", alarm_ids)
+
+    def processRemoveAlarm(self, alarm):
+        self.processRemoveAlarms([alarm.id])
 
-            task = ManagedTask(
-                task_id=async_task.id,
-                alarm=alarm,
+    def processRemoveAlarms(self, alarm_ids):
+        """Removes the given alarms along with all of their tasks, in one
+        transaction and a fixed number of statements.
+        """
+        alarm_ids = list(alarm_ids)
+        if not alarm_ids:
+            return
+        tasks = ManagedTask.__table__
+        history = TaskHistory.__table__
+        alarms = Alarm.__table__
+        self.db.session.execute(
+            tasks.delete().where(tasks.c.alarm_id.in_(alarm_ids)))
+        self.db.session.execute(
+            history.delete().where(history.c.alarm_id.in_(alarm_ids)))
+        self.db.session.execute(
+            alarms.delete().where(alarms.c.id.in_(alarm_ids)))
+        self.db.session.commit()
+        logger.info("removed alarms %s", alarm_ids)
+
+    def _cancelPendingSteps(self, alarm_ids, outcome):
+        """Marks every pending step of the given alarms as ended, in one
+        statement. Callers are expected to bump the alarms' generation.
+        """
+        now = clock.utcnow().replace(second=0, microsecond=0)
+        table = ManagedTask.__table__
+        self.db.session.execute(
+            table.update()
+                .where(table.c.alarm_id.in_(alarm_ids))
+                .where(table.c.ended == None)
+                .values(ended=now, outcome=outcome)
+        )
+
+    def processFiredAlarms(self, now=None):
+        """Moves next_fire_at on to the following day for every active alarm
+        whose fire time has passed. Returns the number of alarms advanced.
+        """
+        if now is None:
+            now = clock.utcnow()
+        fired = (self.db.session.query(
+                Alarm.id,
+                Alarm.time,
+                Alarm.local_time,
+                Alarm.timezone,
             )
-            self.db.session.add(task)
+            .filter(Alarm.next_fire_at <= now)
+            .filter(Alarm.active == True)
+            .all())
+        if not fired:
+            return 0
+        updates = [
+            {
+                'a_id': a_id,
+                'next_fire_at': next_alarm_fire_time(a_time, local_time, tz,
+                    now),
+            }
+            for a_id, a_time, local_time, tz in fired
+        ]
+        table = Alarm.__table__
+        self.db.session.execute(
+            table.update()
+                .where(table.c.id == bindparam('a_id'))
+                .values(next_fire_at=bindparam('next_fire_at')),
+            updates,
+        )
+        self.db.session.commit()
+        logger.info("processFiredAlarms advanced %s alarms", len(updates))
+        return len(updates)
+
+    def processRearmAlarms(self, now=None):
+        """Schedules the next day's run for every active alarm whose last run
+        has finished, a batch of alarms per transaction. Returns the number
+        of alarms re-armed.
+        """
+        if now is None:
+            now = clock.utcnow()
+        now = now.replace(second=0, microsecond=0, tzinfo=None)
 
-        alarm.active = True
-        self.db.session.add(alarm)
+        # Steps that can no longer be sent belong to a finished run.
+        table = ManagedTask.__table__
+        self.db.session.execute(
+            table.update()
+                .where(table.c.alarm_id != None)
+                .where(table.c.ended == None)
+                .where(table.c.eta < now - STEP_EXPIRY)
+                .values(ended=now, outcome=TASK.EXPIRED)
+        )
         self.db.session.commit()
-        logger.info(
-            "processSetAlarm successful - alarm: {}, task: {}".format(
-                alarm, task
-        ))
 
-    def processUnsetAlarm(self, alarm):
-        tasks = ManagedTask.query.filter_by(alarm=alarm, ended=None).all()
-        for task in tasks:
-            celery.AsyncResult(task.task_id).revoke(terminate=True)
-            task.finish()
-            self.db.session.add(task)
-        alarm.active = False
-        self.db.session.add(alarm)
+        pending = (self.db.session.query(ManagedTask.id)
+            .filter(ManagedTask.alarm_id == Alarm.id)
+            .filter(ManagedTask.ended == None))
+        idle_alarms = (Alarm.query
+            .filter(Alarm.active == True)
+            .filter(~pending.exists())
+            .order_by(Alarm.id))
+
+        rearmed = 0
+        while True:
+            alarms = idle_alarms.limit(self.batch_size).all()
+            if not alarms:
+                break
+            self._queueAlarmSteps(
+                [get_alarm_state(alarm) for alarm in alarms], now)
+            rearmed += len(alarms)
+        logger.info("processRearmAlarms re-armed %s alarms", rearmed)
+        return rearmed
+
+    def processTimezoneChange(self, user, timezone):
+        """Moves a user and all of their alarms to a new timezone. Alarms
+        keep their local wall clock time; those whose fire time moves are
+        rescheduled.
+        """
+        users = User.__table__
+        alarms = Alarm.__table__
+        self.db.session.execute(
+            users.update()
+                .where(users.c.id == user.id)
+                .values(timezone=timezone)
+        )
+        self.db.session.execute(
+            alarms.update()
+                .where(alarms.c.owner_id == user.id)
+                .values(timezone=timezone)
+        )
         self.db.session.commit()
-        logger.info("processUnsetAlarm successful - alarm: {}".format(alarm))
+        user_cache.invalidate(user.id)
+        return self.processReschedule(Alarm.owner_id == user.id)
 
-    def processRemoveAlarm(self, alarm):
-        a_id = alarm.id #for logging
-        tasks = ManagedTask.query.filter_by(alarm=alarm)
-        ready_tasks = tasks.filter_by(ended=None)
-        tasks = tasks.all()
-        ready_tasks = ready_tasks.all()
-        if set(ready_tasks) is not set(tasks):
-            for t in set(tasks) - set(ready_tasks):
-                t.finish()
-                logger.info(
-                    "remove alarm {alarm}: cleaned up task {task}".format(
-                        alarm=alarm.id,
-                        task=t.id,
-                ))
-        for t in tasks:
-            logger.info("remove alarm {alarm}: removing task {task}".format(
-                alarm=alarm.id,
-                task=t.id,
-            ))
-            self.db.session.delete(t)
+    def processDstTransitions(self, now=None):
+        """Reschedules the alarms of every zone whose utc offset changes
+        within the next dst_lookahead, so their runs after the transition
+        still ring at the same local time. Returns the number of alarms
+        rescheduled.
+        """
+        if now is None:
+            now = clock.utcnow()
+        zones = [tz for tz, in self.db.session.query(Alarm.timezone)
+            .filter(Alarm.local_time != None)
+            .distinct()]
+        changing = [tz for tz in zones if tz and timezones.has_transition(
+            tz, now, now + self.dst_lookahead)]
+        if not changing:
+            return 0
+        logger.info("processDstTransitions rescheduling zones %s", changing)
+        return self.processReschedule(Alarm.timezone.in_(changing), now)
+
+    def processReschedule(self, clause, now=None):
+        """Recomputes the utc fire time of every alarm matching clause from
+        its local wall clock time, a batch of alarms per transaction. Only
+        alarms whose fire time actually changes are written; active ones
+        among them have their pending steps replaced. Alarms mid run are
+        left for processFiredAlarms. Returns the number rescheduled.
+        """
+        if now is None:
+            now = clock.utcnow()
+        now = now.replace(second=0, microsecond=0, tzinfo=None)
+        query = (Alarm.query
+            .filter(clause)
+            .filter(Alarm.local_time != None)
+            .order_by(Alarm.id))
+
+        rescheduled, after = 0, None
+        while True:
+            batch = query
+            if after is not None:
+                batch = batch.filter(Alarm.id > after)
+            alarms = batch.limit(self.batch_size).all()
+            if not alarms:
+                break
+            after = alarms[-1].id
+
+            # processFiredAlarms may already have moved next_fire_at on, so
+            # a run still under way shows as sendable steps due before it.
+            running = set(a_id for a_id, in self.db.session.query(
+                    ManagedTask.alarm_id)
+                .join(Alarm, Alarm.id == ManagedTask.alarm_id)
+                .filter(ManagedTask.alarm_id.in_([a.id for a in alarms]))
+                .filter(ManagedTask.ended == None)
+                .filter(ManagedTask.eta >= now - STEP_EXPIRY)
+                .filter(ManagedTask.eta < Alarm.next_fire_at)
+                .distinct())
+
+            changed, rearm = [], []
+            for alarm in alarms:
+                if alarm.id in running:
+                    continue
+                if alarm.next_fire_at is not None and alarm.next_fire_at <= now:
+                    continue
+                fire_time = alarm.get_next_fire_time(now)
+                if alarm.active and alarm.next_fire_at != fire_time:
+                    alarm.next_fire_at = fire_time
+                    alarm.generation = alarm.generation + 1
+                    rearm.append(alarm)
+                elif alarm.time == fire_time.time():
+                    continue
+                alarm.time = fire_time.time()
+                changed.append(alarm)
+
+            if rearm:
+                self._cancelPendingSteps([alarm.id for alarm in rearm],
+                    TASK.RESCHEDULED)
+            self.db.session.flush()
+            if rearm:
+                self._queueAlarmSteps(
+                    [get_alarm_state(alarm) for alarm in rearm], now)
+            else:
+                self.db.session.commit()
+            rescheduled += len(changed)
+        logger.info("processReschedule moved %s alarms", rescheduled)
+        return rescheduled
+
+    def _queueAlarmSteps(self, alarms, now):
+        """Activates the alarms, given as AlarmStates, and records their next
+        run as ManagedTasks with one bulk insert, publishing the steps through
+        a single producer unless the dispatcher is in charge of publishing,
+        then commits once.
+        """
+        rows, steps, fire_times = [], [], []
+        for alarm in alarms:
+            base_time = alarm.next_fire_at
+            if base_time is None or base_time <= now:
+                base_time = next_alarm_fire_time(alarm.time, alarm.local_time,
+                    alarm.timezone, now)
+            fire_times.append({'a_id': alarm.id, 'next_fire_at': base_time})
+            for time, action in get_alarm_steps(alarm, base_time):
+                task_id = None
+                if not self.use_dispatcher:
+                    task_id = uuid()
+                    steps.append((task_id, time, action, alarm))
+                rows.append({
+                    'task_id': task_id,
+                    'alarm_id': alarm.id,
+                    'eta': time,
+                    'action': action,
+                    'generation': alarm.generation,
+                    'started': now,
+                    'ended': None,
+                    'outcome': None,
+                })
+
+        self.db.session.execute(ManagedTask.__table__.insert(), rows)
+        if steps:
+            self._publishSteps(steps)
+        table = Alarm.__table__
+        self.db.session.execute(
+            table.update()
+                .where(table.c.id == bindparam('a_id'))
+                .values(active=True, next_fire_at=bindparam('next_fire_at')),
+            fire_times,
+        )
         self.db.session.commit()
-        self.db.session.delete(alarm)
+
+    def _publishSteps(self, steps):
+        """Publishes (task id, eta, action, alarm) steps, just recorded under
+        those celery task ids, through a single producer. Each step carries
+        its ManagedTask id, read back in one query.
+        """
+        m_ids = dict(self.db.session.query(ManagedTask.task_id, ManagedTask.id)
+            .filter(ManagedTask.alarm_id.in_(
+                set(alarm.id for _, _, _, alarm in steps)))
+            .filter(ManagedTask.ended == None))
+        with celery.producer_or_acquire() as producer:
+            for task_id, time, action, alarm in steps:
+                step_task, args, kwargs = get_step_task(action,
+                    alarm.phone_id, alarm.id, alarm.generation, m_ids[task_id])
+                step_task.apply_async(
+                    args=args,
+                    kwargs=kwargs,
+                    task_id=task_id,
+                    eta=time,
+                    expires=time+STEP_EXPIRY,
+                    producer=producer,
+                )
+
+    def processTaskRetention(self, now=None):
+        """Rolls finished ManagedTasks older than the retention window up
+        into TaskHistory and deletes them, one bounded batch per
+        transaction. Returns the number of tasks compacted.
+        """
+        if now is None:
+            now = clock.utcnow()
+        cutoff = now - self.task_retention
+        table = ManagedTask.__table__
+
+        # Sends without an eta that never reported back are not going to.
+        self.db.session.execute(
+            table.update()
+                .where(table.c.eta == None)
+                .where(table.c.ended == None)
+                .where(table.c.started < cutoff)
+                .values(ended=now.replace(second=0, microsecond=0),
+                    outcome=TASK.EXPIRED)
+        )
         self.db.session.commit()
-        logger.info("removed alarm {a_id}".format(a_id=a_id))
 
+        compacted = 0
+        while True:
+            rows = (self.db.session.query(
+                    ManagedTask.id,
+                    ManagedTask.alarm_id,
+                    ManagedTask.ended,
+                    ManagedTask.action,
+                    ManagedTask.outcome,
+                )
+                .filter(ManagedTask.ended != None)
+                .filter(ManagedTask.ended < cutoff)
+                .order_by(ManagedTask.id)
+                .limit(self.batch_size)
+                .all())
+            if not rows:
+                break
+
+            counts = defaultdict(int)
+            for _, alarm_id, ended, action, outcome in rows:
+                counts[(alarm_id, ended.date(), action, outcome)] += 1
+            self._mergeTaskHistory(counts)
+
+            self.db.session.execute(table.delete().where(
+                table.c.id.in_([row[0] for row in rows])))
+            self.db.session.commit()
+            compacted += len(rows)
 
-    def processAlarmResponse(self, alarm):
-        """Handles the process of unsetting and, if neccessary, resetting
-        the given alarm.
+        # Inbound sms sids only need remembering while Twilio might retry.
+        messages = InboundMessage.__table__
+        self.db.session.execute(
+            messages.delete().where(messages.c.received < cutoff))
+        self.db.session.commit()
+        logger.info("processTaskRetention compacted %s tasks", compacted)
+        return compacted
+
+    def _mergeTaskHistory(self, counts):
+        """Adds counts, keyed by (alarm_id, day, action, outcome), onto the
+        matching TaskHistory rows, creating any that do not exist yet.
         """
+        alarm_ids = set(key[0] for key in counts)
+        days = set(key[1] for key in counts)
+        alarm_clause = TaskHistory.alarm_id.in_(
+            [a_id for a_id in alarm_ids if a_id is not None])
+        if None in alarm_ids:
+            alarm_clause = or_(alarm_clause, TaskHistory.alarm_id == None)
+        existing = (TaskHistory.query
+            .filter(alarm_clause)
+            .filter(TaskHistory.day.in_(days))
+            .all())
+        existing = dict(
+            ((h.alarm_id, h.day, h.action, h.outcome), h) for h in existing)
+        for key, count in counts.items():
+            history = existing.get(key)
+            if history is None:
+                history = TaskHistory(*key)
+                self.db.session.add(history)
+            history.count += count
+
+    def processAlarmResponse(self, alarm, rearm=True):
+        self.processAlarmResponses([alarm.id], rearm)
 
-        #This is just a stub for now, more functionality coming soon.
-        logger.info("Processing alarm response for alarm {}".format(alarm))
-        self.processSetAlarm(alarm)
-        self.processUnsetAlarm(alarm)
+    def processAlarmResponses(self, alarm_ids, rearm=True):
+        """Acknowledges the current run of each alarm, cancelling only the
+        steps still pending. Recurring alarms (rearm) stay active and are
+        picked up by the next processRearmAlarms batch; otherwise the
+        alarms are turned off.
+        """
+        alarm_ids = list(alarm_ids)
+        if not alarm_ids:
+            return
+        now = clock.utcnow().replace(second=0, microsecond=0)
+        self._cancelPendingSteps(alarm_ids, TASK.ACKNOWLEDGED)
+        table = Alarm.__table__
+        values = dict(
+            generation=table.c.generation + 1,
+            last_acknowledged=now,
+        )
+        if not rearm:
+            values.update(active=False, next_fire_at=None)
+        self.db.session.execute(
+            table.update()
+                .where(table.c.id.in_(alarm_ids))
+                .values(**values)
+        )
+        self.db.session.commit()
+        logger.info("Processed alarm responses for alarms %s", alarm_ids)
 
     def processRemovePhone(self, phone):
         """Handle removing a phone and any associated objects"""
+        self.processRemovePhones([phone.id])
 
-        p_id = phone.id
-        alarms = phone.alarms.all()
-        for alarm in alarms:
-            self.processRemoveAlarm(alarm)
-        tasks = ManagedTask.query.filter_by(phone=phone)
-        ready_tasks = tasks.filter_by(ended=None)
-        tasks = tasks.all()
-        if set(ready_tasks) is not set(tasks):
-            for t in set(tasks) - set(ready_tasks):
-                t.finish()
-                logger.info(
-                    "remove phone {}: cleaned up tasks {}".format(
-                    phone.id, t.id
-                ))
-        for t in tasks:
-            logger.info(
-                "remove phone {}: removing task {}".format(phone.id, t.id))
-            self.db.session.delete(t)
+    def processRemovePhones(self, phone_ids):
+        """Removes the given phones, their alarms and every task tied to
+        either, in one transaction and a fixed number of statements.
+        """
+        phone_ids = list(phone_ids)
+        if not phone_ids:
+            return
+        self._deletePhones(Phone.__table__.c.id.in_(phone_ids))
         self.db.session.commit()
-        self.db.session.delete(phone)
+        logger.info("Removed phones %s", phone_ids)
+
+    def processRemoveUser(self, user):
+        """Removes a user's account along with all of their phones, alarms,
+        tasks and queued emails, in one transaction and a fixed number of
+        statements.
+        """
+        u_id = user.id
+        tasks = ManagedTask.__table__
+        queued = QueuedEmail.__table__
+        users = User.__table__
+        self._deletePhones(Phone.__table__.c.owner_id == u_id)
+        self.db.session.execute(
+            tasks.delete().where(tasks.c.user_id == u_id))
+        self.db.session.execute(
+            queued.delete().where(queued.c.user_id == u_id))
+        self.db.session.execute(
+            users.delete().where(users.c.id == u_id))
         self.db.session.commit()
-        logger.info("Removed phone {}".format(p_id))
+        user_cache.invalidate(u_id)
+        logger.info("Removed user %s", u_id)
+
+    def _deletePhones(self, phone_clause):
+        """Deletes the phones matching phone_clause with their alarms and
+        tasks. The caller commits.
+        """
+        tasks = ManagedTask.__table__
+        history = TaskHistory.__table__
+        alarms = Alarm.__table__
+        phones = Phone.__table__
+        messages = InboundMessage.__table__
+        phone_ids = select([phones.c.id]).where(phone_clause)
+        alarm_ids = select([alarms.c.id]).where(alarms.c.phone_id.in_(phone_ids))
+        self.db.session.execute(
+            tasks.delete().where(or_(
+                tasks.c.alarm_id.in_(alarm_ids),
+                tasks.c.phone_id.in_(phone_ids),
+            )))
+        self.db.session.execute(
+            history.delete().where(history.c.alarm_id.in_(alarm_ids)))
+        self.db.session.execute(
+            alarms.delete().where(alarms.c.phone_id.in_(phone_ids)))
+        self.db.session.execute(
+            messages.delete().where(messages.c.phone_id.in_(phone_ids)))
+        self.db.session.execute(phones.delete().where(phone_clause))
 
     def processWelcomeEmail(self, user):
         """Provides an easy way to send the user a pre constructed welcome email."""
@@ -181,12 +657,11 @@ class TaskManager:
             "Hello {name},\n\nWelcome to AlarmAway, get started now!".format(
             name=user.name
         ))
-        async = tasks.send_user_email.apply_async(
-            args=(user.id, subject,),
-            kwargs=dict(sender=sender, body_text=body_text),
-            )
-        task = ManagedTask(task_id=async.id, user=user)
-        self.db.session.add(task)
-        self.db.session.commit()
-        logger.info("processWelcomeEmail success - user: {}, task: {}.".format(
-            user, task))
+        email = emails.queue_email(subject,
+            recipients=[user.email],
+            sender=sender,
+            body_text=body_text,
+            user=user,
+        )
+        logger.info("processWelcomeEmail success - user: %s, email: %s.",
+            user, email)
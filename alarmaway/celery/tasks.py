@@ -1,65 +1,379 @@
 from __future__ import absolute_import
+from collections import defaultdict
+import datetime
+from multiprocessing.pool import ThreadPool
 
-from twilio.rest import TwilioRestClient
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.sql import bindparam
 
-from .. import emails
+from .. import app, clock, db, emails
+from . import constants as TASK
 from .celery import celery
-from .config import (
-    TWILIO_FROM_NUMBER, TWILIO_ACCOUNT_ID, TWILIO_SECRET_TOKEN,
-    DEFAULT_CALL_URL
-)
+from .config import TWILIO_FROM_NUMBER, DEFAULT_CALL_URL
+from .models import ManagedTask, QueuedEmail
+from .provider import get_client
+from .ratelimit import get_limiter
+from ..alarms.models import Alarm
 from ..phones.models import Phone
+from ..responses.models import InboundMessage
 from ..users.models import User
 
 import logging
 logger = logging.getLogger('alarmaway')
 
-client = TwilioRestClient(
-    account=TWILIO_ACCOUNT_ID,
-    token=TWILIO_SECRET_TOKEN,
+# How long after its eta a step is still worth sending.
+STEP_EXPIRY = datetime.timedelta(seconds=120)
+
+def is_stale_step(alarm_id, generation):
+    """Alarm steps carry the generation of the alarm they were scheduled
+    for. Unsetting or answering an alarm bumps its generation, so any step
+    whose generation no longer matches (or whose alarm is gone) is stale.
+    """
+    if alarm_id is None:
+        return False
+    current = (db.session.query(Alarm.generation)
+        .filter(Alarm.id == alarm_id)
+        .scalar())
+    return current is None or current != generation
+
+def finish_step(m_id, outcome, picked_up=None, sid=None):
+    """Records how the send of a ManagedTask went, by primary key: its
+    outcome, when it was picked up and, if the provider accepted it, when
+    and under what sid.
+    """
+    if m_id is None:
+        return
+    now = clock.utcnow()
+    table = ManagedTask.__table__
+    db.session.execute(
+        table.update()
+            .where(table.c.id == m_id)
+            .values(
+                picked_up=picked_up,
+                accepted=now if sid is not None else None,
+                return_id=sid,
+                ended=now.replace(second=0, microsecond=0),
+                outcome=outcome,
+            )
     )
+    db.session.commit()
 
-@celery.task
-def send_sms_message(phone_id, message, *args, **kwargs):
+def throttle(task, provider, priority, m_id=None, picked_up=None):
+    """Retries the running task later if the provider's rate limit has no
+    room for a send at this priority; returns True when the send may go
+    ahead. A step that could only be retried past its eta + STEP_EXPIRY is
+    recorded as failed instead, and False returned.
+    """
+    wait = get_limiter().acquire(provider, priority)
+    if not wait:
+        return True
+    if m_id is not None:
+        eta = (db.session.query(ManagedTask.eta)
+            .filter(ManagedTask.id == m_id)
+            .scalar())
+        retry_at = clock.utcnow() + datetime.timedelta(seconds=wait)
+        if eta is not None and retry_at > eta + STEP_EXPIRY:
+            logger.warn("rate limited step %s given up as too late", m_id)
+            finish_step(m_id, TASK.FAILED, picked_up)
+            return False
+    raise task.retry(countdown=wait)
+
+@celery.task(max_retries=None)
+def send_sms_message(phone_id, message, alarm_id=None, generation=None,
+        m_id=None, *args, **kwargs):
+    picked_up = clock.utcnow()
+    if is_stale_step(alarm_id, generation):
+        logger.info("skipping stale sms step for alarm %s", alarm_id)
+        return
+    priority = (TASK.PRIORITY_FOLLOWUP if alarm_id is not None
+        else TASK.PRIORITY_MESSAGE)
+    if not throttle(send_sms_message, TASK.TWILIO, priority, m_id, picked_up):
+        return
     phone = Phone.query.filter_by(id=phone_id).first()
-    sms_message = client.sms.messages.create(
-        to=phone.number,
-        from_=TWILIO_FROM_NUMBER,
-        body=message,
-        )
-    logger.info(
-        "sms_message sent to {num}: {msg}".format(
-            num=phone.number,
-            msg=sms_message,
-    ))
+    try:
+        sms_message = get_client().send_sms(
+            to=phone.number,
+            from_=TWILIO_FROM_NUMBER,
+            body=message,
+            )
+    except Exception:
+        finish_step(m_id, TASK.FAILED, picked_up)
+        raise
+    logger.info("sms_message sent to %s: %s",
+        phone.number, sms_message.get('sid'))
+    finish_step(m_id, TASK.SENT, picked_up, sms_message.get('sid'))
 
-@celery.task
-def send_phone_call(phone_id, message_url=DEFAULT_CALL_URL):
+@celery.task(max_retries=None)
+def send_phone_call(phone_id, message_url=DEFAULT_CALL_URL, alarm_id=None,
+        generation=None, m_id=None):
+    picked_up = clock.utcnow()
+    if is_stale_step(alarm_id, generation):
+        logger.info("skipping stale call step for alarm %s", alarm_id)
+        return
+    if not throttle(send_phone_call, TASK.TWILIO, TASK.PRIORITY_CALL, m_id,
+            picked_up):
+        return
     phone = Phone.query.filter_by(id=phone_id).first()
-    phone_call = client.calls.create(
-        to=phone.number,
-        from_=TWILIO_FROM_NUMBER,
-        url=message_url,
+    try:
+        phone_call = get_client().make_call(
+            to=phone.number,
+            from_=TWILIO_FROM_NUMBER,
+            url=message_url,
+            )
+    except Exception:
+        finish_step(m_id, TASK.FAILED, picked_up)
+        raise
+    logger.info("phone call sent to %s: %s",
+        phone.number, phone_call.get('sid'))
+    finish_step(m_id, TASK.SENT, picked_up, phone_call.get('sid'))
+
+def _send_job(job):
+    """Performs one send_batch job, returning the job with its provider sid,
+    or None as the sid if the send failed. The time the provider accepted
+    it is stored on the job.
+    """
+    client = get_client()
+    try:
+        if job['action'] == TASK.SMS:
+            result = client.send_sms(
+                to=job['number'],
+                from_=TWILIO_FROM_NUMBER,
+                body=job['message'],
+            )
+        else:
+            result = client.make_call(
+                to=job['number'],
+                from_=TWILIO_FROM_NUMBER,
+                url=job.get('url', DEFAULT_CALL_URL),
+            )
+    except Exception as err:
+        logger.warn("send_batch %s to %s failed: %s",
+            job['action'], job['number'], err)
+        return job, None
+    job['accepted'] = clock.utcnow()
+    return job, result.get('sid')
+
+@celery.task
+def send_batch(jobs):
+    """Sends a batch of sms and call jobs concurrently and records each
+    result on its ManagedTask. Jobs are dicts as built by
+    task_manager.get_step_job; those more than STEP_EXPIRY past their eta
+    are expired instead. At most SEND_CONCURRENCY sends are in flight at
+    once, sharing this process's pooled Twilio connections.
+    """
+    picked_up = clock.utcnow()
+    expired_before = clock.time() - STEP_EXPIRY.total_seconds()
+    alarm_ids = set(job['alarm_id'] for job in jobs if job.get('alarm_id'))
+    generations = dict(db.session.query(Alarm.id, Alarm.generation)
+        .filter(Alarm.id.in_(alarm_ids))
+        .all()) if alarm_ids else {}
+    phone_ids = set(job['phone_id'] for job in jobs)
+    numbers = dict(db.session.query(Phone.id, Phone.number)
+        .filter(Phone.id.in_(phone_ids))
+        .all())
+
+    results = []
+    by_priority = defaultdict(list)
+    for job in jobs:
+        stale = job.get('alarm_id') and (
+            generations.get(job['alarm_id']) != job['generation'])
+        number = numbers.get(job['phone_id'])
+        if stale or number is None:
+            results.append((job, None, TASK.CANCELLED))
+        elif job.get('eta') and job['eta'] < expired_before:
+            results.append((job, None, TASK.EXPIRED))
+        else:
+            job['number'] = number
+            by_priority[TASK.PRIORITY_CALL if job['action'] == TASK.CALL
+                else TASK.PRIORITY_FOLLOWUP].append(job)
+
+    # One trip to the rate limiter per priority, calls first.
+    limiter = get_limiter()
+    live, deferred = [], []
+    wait = 0
+    for priority in sorted(by_priority):
+        group = by_priority[priority]
+        granted, group_wait = limiter.acquire_many(
+            TASK.TWILIO, priority, len(group))
+        live.extend(group[:granted])
+        if granted < len(group):
+            deferred.extend(group[granted:])
+            wait = max(wait, group_wait)
+
+    if deferred:
+        # The rest goes out once the rate limit has room for it, as long
+        # as that is still in time for the earliest of them.
+        etas = [job['eta'] for job in deferred if job.get('eta')]
+        send_batch.apply_async(
+            args=(deferred,),
+            countdown=wait,
+            expires=(datetime.datetime.utcfromtimestamp(min(etas))
+                + STEP_EXPIRY) if etas else None,
         )
-    logger.info(
-        "phone call sent to {num}: {call}".format(
-            num=phone.number,
-            call=phone_call,
-    ))
+
+    if live:
+        get_client()
+        pool = ThreadPool(min(len(live), app.config.get('SEND_CONCURRENCY', 10)))
+        try:
+            for job, sid in pool.imap_unordered(_send_job, live):
+                results.append(
+                    (job, sid, TASK.SENT if sid is not None else TASK.FAILED))
+        finally:
+            pool.close()
+            pool.join()
+
+    now = clock.utcnow().replace(second=0, microsecond=0)
+    updates = [
+        {
+            'm_id': job['m_id'],
+            'return_id': sid,
+            'outcome': outcome,
+            'picked_up': picked_up,
+            'accepted': job.get('accepted'),
+        }
+        for job, sid, outcome in results if job.get('m_id') is not None
+    ]
+    if updates:
+        table = ManagedTask.__table__
+        db.session.execute(
+            table.update()
+                .where(table.c.id == bindparam('m_id'))
+                .values(
+                    return_id=bindparam('return_id'),
+                    outcome=bindparam('outcome'),
+                    picked_up=bindparam('picked_up'),
+                    accepted=bindparam('accepted'),
+                    ended=now,
+                ),
+            updates,
+        )
+        db.session.commit()
+    logger.info("send_batch sent %s of %s jobs",
+        sum(1 for _, _, outcome in results if outcome == TASK.SENT), len(jobs))
 
 @celery.task
 def send_user_email(user_id, subject, *args, **kwargs):
-    user = User.query.filter_by(id=user_id).first()
-    if not user:
-        #TODO
-        return
-
-    if not 'recipients' in kwargs:
+    """Queues an email to a user for the next batched flush. Callers that
+    pass recipients save the User lookup.
+    """
+    if not kwargs.get('recipients'):
+        user = User.query.filter_by(id=user_id).first()
+        if not user:
+            #TODO
+            return
         kwargs['recipients'] = [user.email]
-    elif user.email not in kwargs['recipients']:
-        kwargs['recipients'].append(user.email)
 
-    emails.send_email(subject, *args, **kwargs)
+    emails.queue_email(subject, *args, **kwargs)
+
+@celery.task
+def flush_email_queue():
+    """Drains the email queue, EMAIL_BATCH_SIZE messages per SMTP session,
+    stopping early when the smtp rate limit has no room. Each message is
+    tried at most once per flush; one the server refuses is kept for the
+    next flush and dropped after EMAIL_MAX_ATTEMPTS refusals, so it never
+    holds up the messages queued behind it.
+    """
+    batch_size = app.config.get('EMAIL_BATCH_SIZE', 50)
+    max_attempts = app.config.get('EMAIL_MAX_ATTEMPTS', 5)
+    limiter = get_limiter()
+    table = QueuedEmail.__table__
+    flushed, after = 0, 0
+    while True:
+        waiting = (QueuedEmail.query
+            .filter(QueuedEmail.id > after)
+            .order_by(QueuedEmail.id)
+            .limit(batch_size)
+            .count())
+        granted = waiting and limiter.acquire_up_to(
+            TASK.SMTP, TASK.PRIORITY_MESSAGE, waiting)
+        if not granted:
+            break
+        allowed = (QueuedEmail.query
+            .with_lockmode('update')
+            .filter(QueuedEmail.id > after)
+            .order_by(QueuedEmail.id)
+            .limit(granted)
+            .all())
+        if not allowed:
+            break
+        after = allowed[-1].id
+
+        # Flask-Mail reads its settings off current_app, which a worker
+        # has no context for of its own.
+        with app.app_context():
+            results = emails.send_messages([
+                emails.build_message(
+                    email.subject,
+                    recipients=email.getRecipients(),
+                    sender=email.sender,
+                    body_text=email.body_text,
+                    body_html=email.body_html,
+                )
+                for email in allowed
+            ])
+        sent, retry, dropped = [], [], []
+        for email, result in zip(allowed, results):
+            if result:
+                sent.append(email.id)
+            elif result is False and (email.attempts or 0) + 1 < max_attempts:
+                retry.append(email.id)
+            elif result is False:
+                logger.error("dropping email %s to %s after %s attempts",
+                    email.id, email.recipients, max_attempts)
+                dropped.append(email.id)
+        if sent or dropped:
+            db.session.execute(table.delete().where(
+                table.c.id.in_(sent + dropped)))
+        if retry:
+            db.session.execute(table.update()
+                .where(table.c.id.in_(retry))
+                .values(attempts=db.func.coalesce(table.c.attempts, 0) + 1))
+        db.session.commit()
+        flushed += len(sent)
+        if None in results or waiting < batch_size:
+            break
+    logger.info("flush_email_queue sent %s emails", flushed)
+    return flushed
+
+@celery.task
+def process_alarm_responses(alarm_ids, message_sid=None, phone_id=None):
+    """Handles an inbound 'I'm up' sms queued by the responses webhook.
+    Repeat deliveries of the same message sid are dropped.
+    """
+    from .. import task_manager
+    if message_sid is not None:
+        db.session.add(InboundMessage(message_sid, phone_id))
+        try:
+            db.session.commit()
+        except IntegrityError:
+            db.session.rollback()
+            logger.info("dropping duplicate sms %s", message_sid)
+            return
+    task_manager.processAlarmResponses(alarm_ids)
+
+@celery.task
+def advance_fired_alarms():
+    """Periodic task keeping Alarm.next_fire_at current once alarms fire."""
+    from .. import task_manager
+    return task_manager.processFiredAlarms()
+
+@celery.task
+def rearm_alarms():
+    """Periodic task scheduling the next day's run of recurring alarms."""
+    from .. import task_manager
+    return task_manager.processRearmAlarms()
+
+@celery.task
+def reschedule_dst_alarms():
+    """Periodic task moving alarms ahead of their zone's DST transitions."""
+    from .. import task_manager
+    return task_manager.processDstTransitions()
+
+@celery.task
+def compact_task_history():
+    """Periodic task moving finished ManagedTasks into TaskHistory."""
+    from .. import task_manager
+    return task_manager.processTaskRetention()
 
 @celery.task
 def greet(name, id=None):
@@ -0,0 +1,67 @@
+from __future__ import absolute_import, division, print_function
+import calendar
+from datetime import datetime, timedelta
+import time as _time
+
+class SystemClock(object):
+    """The real wall clock."""
+
+    def utcnow(self):
+        return datetime.utcnow()
+
+    def time(self):
+        return _time.time()
+
+    def sleep(self, seconds):
+        _time.sleep(seconds)
+
+
+class SimulatedClock(object):
+    """A clock that only moves when told to, so a day of scheduling can be
+    replayed in seconds. Sleeping simply advances it.
+    """
+
+    def __init__(self, start=None):
+        if start is None:
+            start = datetime.utcnow()
+        self.now = start.replace(tzinfo=None)
+
+    def utcnow(self):
+        return self.now
+
+    def time(self):
+        return calendar.timegm(self.now.utctimetuple()) + (
+            self.now.microsecond / 1e6)
+
+    def sleep(self, seconds):
+        self.advance(seconds=seconds)
+
+    def advance(self, **kwargs):
+        """Moves the clock forward by the given timedelta arguments."""
+        self.now = self.now + timedelta(**kwargs)
+        return self.now
+
+
+_clock = SystemClock()
+
+def get_clock():
+    return _clock
+
+def set_clock(clock):
+    """Installs the clock every part of alarmaway reads time from, returning
+    the previous one.
+    """
+    global _clock
+    previous, _clock = _clock, clock
+    return previous
+
+def utcnow():
+    """Returns the current naive utc datetime from the installed clock."""
+    return _clock.utcnow()
+
+def time():
+    """Returns the current epoch seconds from the installed clock."""
+    return _clock.time()
+
+def sleep(seconds):
+    _clock.sleep(seconds)
@@ -1,17 +1,20 @@
 from flask.ext.mail import Message
 import logging
+import smtplib
+import socket
 
-from alarmaway import mail
+from alarmaway import db, mail
+from alarmaway.celery.models import QueuedEmail
 
 logger = logging.getLogger("alarmaway")
 
-def send_email(subject,
+def build_message(subject,
     recipients=[],
     sender=None,
     body_text=None,
     body_html=None,
     ):
-    """Sends an email using the alarmaway Flask-Mail client."""
+    """Builds a Flask-Mail message, preferring the html body if given."""
 
     msg = Message(subject,
         recipients=recipients,
@@ -22,6 +25,60 @@ def send_email(subject,
         msg.html = body_html
     else:
         msg.body = body_text
-    logger.info("sending email to {recipients}: {msg}".format(
-        recipients=recipients, msg=msg))
+    return msg
+
+def send_email(subject,
+    recipients=[],
+    sender=None,
+    body_text=None,
+    body_html=None,
+    ):
+    """Sends an email using the alarmaway Flask-Mail client."""
+
+    msg = build_message(subject, recipients, sender, body_text, body_html)
+    logger.info("sending email to %s: %s", recipients, msg)
     mail.send(msg)
+
+def send_messages(messages):
+    """Sends the given messages over a single SMTP connection. Returns a
+    list holding, for each message, True if it was sent, False if it was
+    refused and None if it was never tried because the connection failed.
+    """
+    results = [None] * len(messages)
+    try:
+        with mail.connect() as conn:
+            for position, msg in enumerate(messages):
+                try:
+                    conn.send(msg)
+                except (smtplib.SMTPServerDisconnected, socket.error):
+                    raise
+                except Exception:
+                    logger.exception("email to %s refused", msg.recipients)
+                    results[position] = False
+                else:
+                    results[position] = True
+    except Exception:
+        logger.exception("email batch failed after %s of %s messages",
+            results.count(True), len(messages))
+    return results
+
+def queue_email(subject,
+    recipients=[],
+    sender=None,
+    body_text=None,
+    body_html=None,
+    user=None,
+    ):
+    """Queues an email for the next batched flush of the email queue. The
+    recipients are stored with it, so nothing needs looking up at send time.
+    """
+    email = QueuedEmail(subject, recipients,
+        sender=sender,
+        body_text=body_text,
+        body_html=body_html,
+        user=user,
+    )
+    db.session.add(email)
+    db.session.commit()
+    logger.info("queued email to %s: %s", recipients, email)
+    return email
@@ -0,0 +1,90 @@
+"""Replays a full day of alarm scheduling on a simulated clock and reports
+what the scheduler costs for each simulated minute.
+
+    python -m alarmaway.loadtest.benchmark --alarms 100000
+
+Nothing is sent: steps are published to an in-memory broker, so the
+numbers cover scheduling, dispatch and bookkeeping only. Use a scratch
+database (--database-uri).
+"""
+from __future__ import absolute_import, division, print_function
+import argparse
+import datetime
+import time
+
+from .. import app, clock, db, task_manager
+from ..celery.celery import celery
+from .simulator import MorningSimulator, percentile
+
+def replay_day(alarms, seed=None, rearm_every=5):
+    """Seeds alarms spread over a simulated day, then ticks the dispatcher
+    once per simulated minute (running the re-arm stage every rearm_every
+    minutes, as beat would). Returns (wall seconds, statements, steps
+    published) for each minute.
+    """
+    from ..celery.dispatcher import Dispatcher
+
+    start = datetime.datetime(2013, 3, 1, 0, 0)
+    sim_clock = clock.SimulatedClock(start)
+    previous = clock.set_clock(sim_clock)
+    try:
+        simulator = MorningSimulator(alarms, 24 * 60, seed=seed)
+        counters = simulator.counters
+        counters.install()
+        simulator.seed(start + datetime.timedelta(minutes=1))
+        task_manager.use_dispatcher = True
+        task_manager.processRearmAlarms()
+
+        dispatcher = Dispatcher(db)
+        minutes = []
+        for minute in range(24 * 60 + 20):
+            sim_clock.advance(minutes=1)
+            statements = counters.statements
+            began = time.time()
+            published = dispatcher.tick()
+            if minute % rearm_every == 0:
+                task_manager.processRearmAlarms()
+            minutes.append((
+                time.time() - began,
+                counters.statements - statements,
+                published,
+            ))
+        return minutes
+    finally:
+        clock.set_clock(previous)
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--alarms', type=int, default=100000)
+    parser.add_argument('--seed', type=int, default=None)
+    parser.add_argument('--database-uri', default=None)
+    parser.add_argument('--rearm-every', type=int, default=5)
+    args = parser.parse_args()
+
+    if args.database_uri:
+        app.config['SQLALCHEMY_DATABASE_URI'] = args.database_uri
+    db.create_all()
+    celery.conf.update(BROKER_URL='memory://', CELERY_ALWAYS_EAGER=False)
+
+    began = time.time()
+    minutes = replay_day(args.alarms, seed=args.seed,
+        rearm_every=args.rearm_every)
+    seconds = [wall for wall, _, _ in minutes]
+    statements = [count for _, count, _ in minutes]
+    published = [count for _, _, count in minutes]
+    report = {
+        'alarms': args.alarms,
+        'replay_seconds': time.time() - began,
+        'minute_seconds_p50': percentile(seconds, 50),
+        'minute_seconds_p95': percentile(seconds, 95),
+        'minute_seconds_max': max(seconds),
+        'minute_statements_p50': percentile(statements, 50),
+        'minute_statements_max': max(statements),
+        'steps_published': sum(published),
+        'peak_steps_per_minute': max(published),
+    }
+    for key in sorted(report):
+        print("{:<24} {}".format(key, report[key]))
+
+if __name__ == '__main__':
+    main()
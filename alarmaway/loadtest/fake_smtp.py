@@ -0,0 +1,59 @@
+"""An SMTP sink for load testing email delivery. Point MAIL_SERVER and
+MAIL_PORT at it (with MAIL_USE_TLS and MAIL_USE_SSL off), e.g.
+
+    python -m alarmaway.loadtest.fake_smtp --port 8025 --latency 0.05
+"""
+from __future__ import absolute_import, division, print_function
+import argparse
+import asyncore
+import random
+import smtpd
+import threading
+import time
+
+class FakeSMTPServer(smtpd.SMTPServer):
+    """Swallows every message after a random delay around latency, refusing
+    error_rate of them with a temporary failure. Deliveries are recorded in
+    self.messages as (recipients, received_at, accepted).
+    """
+
+    def __init__(self, address, latency=0.05, jitter=0.02, error_rate=0.0):
+        smtpd.SMTPServer.__init__(self, address, None)
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.messages = []
+
+    def process_message(self, peer, mailfrom, rcpttos, data):
+        received_at = time.time()
+        time.sleep(max(0, random.gauss(self.latency, self.jitter)))
+        if random.random() < self.error_rate:
+            self.messages.append((rcpttos, received_at, False))
+            return '451 Simulated failure'
+        self.messages.append((rcpttos, received_at, True))
+
+    def start(self):
+        thread = threading.Thread(target=asyncore.loop, kwargs={'timeout': 1})
+        thread.daemon = True
+        thread.start()
+        return thread
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--host', default='localhost')
+    parser.add_argument('--port', type=int, default=8025)
+    parser.add_argument('--latency', type=float, default=0.05)
+    parser.add_argument('--jitter', type=float, default=0.02)
+    parser.add_argument('--error-rate', type=float, default=0.0)
+    args = parser.parse_args()
+    FakeSMTPServer((args.host, args.port),
+        latency=args.latency,
+        jitter=args.jitter,
+        error_rate=args.error_rate,
+    )
+    print("fake smtp listening on {}:{}".format(args.host, args.port))
+    asyncore.loop()
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,107 @@
+"""A stand-in for the Twilio REST API, for load testing alarm dispatch
+without placing real calls. Point TWILIO_API_BASE at it, e.g.
+
+    python -m alarmaway.loadtest.fake_twilio --port 8099 --latency 0.3
+    TWILIO_API_BASE = 'http://localhost:8099/2010-04-01'
+"""
+from __future__ import absolute_import, division, print_function
+import argparse
+from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+import json
+import random
+import threading
+import time
+import urlparse
+import uuid
+from SocketServer import ThreadingMixIn
+
+RESOURCES = {
+    'Calls.json': 'CA',
+    'Messages.json': 'SM',
+}
+
+class FakeTwilioServer(ThreadingMixIn, HTTPServer):
+    """Accepts sms and call requests after a random delay around latency,
+    failing error_rate of them with a 500. Every request is recorded in
+    self.requests as (resource, to, received_at, accepted).
+    """
+
+    daemon_threads = True
+
+    def __init__(self, address, latency=0.2, jitter=0.1, error_rate=0.0):
+        HTTPServer.__init__(self, address, FakeTwilioHandler)
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.requests = []
+        self.lock = threading.Lock()
+
+    @property
+    def base_url(self):
+        return 'http://{}:{}/2010-04-01'.format(*self.server_address)
+
+    def record(self, resource, to, received_at, accepted):
+        with self.lock:
+            self.requests.append((resource, to, received_at, accepted))
+
+    def start(self):
+        thread = threading.Thread(target=self.serve_forever)
+        thread.daemon = True
+        thread.start()
+        return thread
+
+
+class FakeTwilioHandler(BaseHTTPRequestHandler):
+
+    def do_POST(self):
+        received_at = time.time()
+        resource = self.path.rsplit('/', 1)[-1]
+        length = int(self.headers.getheader('content-length') or 0)
+        form = urlparse.parse_qs(self.rfile.read(length))
+        to = form.get('To', [None])[0]
+
+        server = self.server
+        time.sleep(max(0, random.gauss(server.latency, server.jitter)))
+        if resource not in RESOURCES:
+            self.respond(404, {'message': 'Unknown resource'})
+        elif random.random() < server.error_rate:
+            server.record(resource, to, received_at, False)
+            self.respond(500, {'message': 'Simulated failure'})
+        else:
+            server.record(resource, to, received_at, True)
+            self.respond(201, {
+                'sid': RESOURCES[resource] + uuid.uuid4().hex,
+                'to': to,
+                'status': 'queued',
+            })
+
+    def respond(self, status, body):
+        payload = json.dumps(body)
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def log_message(self, *args):
+        pass
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--host', default='localhost')
+    parser.add_argument('--port', type=int, default=8099)
+    parser.add_argument('--latency', type=float, default=0.2)
+    parser.add_argument('--jitter', type=float, default=0.1)
+    parser.add_argument('--error-rate', type=float, default=0.0)
+    args = parser.parse_args()
+    server = FakeTwilioServer((args.host, args.port),
+        latency=args.latency,
+        jitter=args.jitter,
+        error_rate=args.error_rate,
+    )
+    print("fake twilio listening on {}".format(server.base_url))
+    server.serve_forever()
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,247 @@
+"""Simulates a morning alarm peak against the local Twilio stand-in and
+reports dispatch throughput, send lateness, and broker and db load.
+
+    python -m alarmaway.loadtest.simulator --users 5000 --minutes 60
+
+Use a scratch database (--database-uri); the run seeds users, phones and
+alarms into it. By default celery runs eagerly in this process. With
+--broker, steps are published to the configured broker and real workers
+(pointed at the same fake Twilio base url) do the sending.
+"""
+from __future__ import absolute_import, division, print_function
+import argparse
+import calendar
+from collections import defaultdict
+import datetime
+import random
+import time
+import uuid
+
+from sqlalchemy import event
+
+from .. import app, clock, db, task_manager
+from ..alarms.models import Alarm
+from ..celery.celery import celery
+from ..celery.models import ManagedTask
+from ..phones.models import Phone
+from ..users.models import User
+from ..utils import get_timezone_list
+from .fake_twilio import FakeTwilioServer
+
+def spread_alarm_offsets(count, minutes, rng):
+    """Returns count minute offsets within the window on the same ten
+    minute marks the alarm form offers, clustered on the hour and half
+    hour the way real alarm times are.
+    """
+    marks = range(0, minutes, 10)
+    hours = [m for m in marks if m % 60 == 0]
+    halves = [m for m in marks if m % 60 == 30] or hours
+    offsets = []
+    for _ in range(count):
+        roll = rng.random()
+        if roll < 0.45:
+            offsets.append(rng.choice(hours))
+        elif roll < 0.65:
+            offsets.append(rng.choice(halves))
+        else:
+            offsets.append(rng.choice(marks))
+    return offsets
+
+def percentile(values, pct):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    index = min(len(values) - 1, int(round(pct / 100 * (len(values) - 1))))
+    return values[index]
+
+def to_epoch(dt):
+    return calendar.timegm(dt.utctimetuple())
+
+
+class LoadCounters(object):
+    """Counts sql statements and broker publishes made by this process."""
+
+    def __init__(self):
+        self.statements = 0
+        self.publishes = 0
+        self.executed = 0
+
+    def install(self):
+        from celery import signals
+
+        event.listen(db.engine, 'before_cursor_execute', self.on_statement)
+        publish_signal = getattr(signals, 'before_task_publish', None)
+        if publish_signal is None:
+            publish_signal = signals.task_sent
+        publish_signal.connect(self.on_publish, weak=False)
+        signals.task_prerun.connect(self.on_prerun, weak=False)
+
+    def on_statement(self, *args, **kwargs):
+        self.statements += 1
+
+    def on_publish(self, *args, **kwargs):
+        self.publishes += 1
+
+    def on_prerun(self, *args, **kwargs):
+        self.executed += 1
+
+
+class MorningSimulator(object):
+
+    def __init__(self, users, minutes, lead=2, seed=None, twilio=None):
+        self.users = users
+        self.minutes = minutes
+        self.lead = lead
+        self.rng = random.Random(seed)
+        self.twilio = twilio
+        self.tag = uuid.uuid4().hex[:8]
+        self.counters = LoadCounters()
+        self.report = {}
+
+    def seed(self, start):
+        """Bulk inserts one user, phone and active alarm per simulated user,
+        with alarms spread over the window starting at start.
+        """
+        timezones = get_timezone_list()
+        now = clock.utcnow()
+        base_number = self.rng.randint(1000000000, 8999999999 - self.users)
+        offsets = spread_alarm_offsets(self.users, self.minutes, self.rng)
+
+        db.session.execute(User.__table__.insert(), [{
+            'name': 'sim-{}-{}'.format(self.tag, n),
+            'email': 'sim-{}-{}@example.com'.format(self.tag, n),
+            'password': 'x',
+            'created': now,
+            'timezone': self.rng.choice(timezones),
+        } for n in range(self.users)])
+        user_ids = [u_id for u_id, in db.session.query(User.id)
+            .filter(User.email.like('sim-{}-%'.format(self.tag)))
+            .order_by(User.id)]
+
+        db.session.execute(Phone.__table__.insert(), [{
+            'number': str(base_number + n),
+            'verified': True,
+            'created': now,
+            'owner_id': u_id,
+        } for n, u_id in enumerate(user_ids)])
+        phone_ids = [p_id for p_id, in db.session.query(Phone.id)
+            .filter(Phone.owner_id.in_(user_ids))
+            .order_by(Phone.owner_id)]
+
+        fire_times = [start + datetime.timedelta(minutes=m) for m in offsets]
+        db.session.execute(Alarm.__table__.insert(), [{
+            'time': fire_time.time(),
+            'active': True,
+            'next_fire_at': fire_time,
+            'generation': 0,
+            'created': now,
+            'owner_id': u_id,
+            'phone_id': p_id,
+        } for u_id, p_id, fire_time in zip(user_ids, phone_ids, fire_times)])
+        db.session.commit()
+        return user_ids
+
+    def run(self):
+        from ..celery.dispatcher import Dispatcher, floor_minute
+
+        self.counters.install()
+        start = floor_minute(clock.utcnow()) + datetime.timedelta(
+            minutes=self.lead)
+        began = time.time()
+        user_ids = self.seed(start)
+        self.report['seed_seconds'] = time.time() - began
+
+        began = time.time()
+        statements = self.counters.statements
+        task_manager.use_dispatcher = True
+        task_manager.processRearmAlarms()
+        self.report['schedule_seconds'] = time.time() - began
+        self.report['schedule_statements'] = (
+            self.counters.statements - statements)
+
+        dispatcher = Dispatcher(db)
+        end = start + datetime.timedelta(minutes=self.minutes + 20)
+        tick_seconds = []
+        while clock.utcnow() < end:
+            began = time.time()
+            dispatcher.tick()
+            tick_seconds.append(time.time() - began)
+            now = clock.utcnow()
+            next_minute = floor_minute(now) + datetime.timedelta(minutes=1)
+            clock.sleep((next_minute - now).total_seconds())
+        self.report['tick_seconds_max'] = max(tick_seconds)
+        self.report['tick_seconds_mean'] = sum(tick_seconds) / len(tick_seconds)
+        self.collect(user_ids)
+        return self.report
+
+    def collect(self, user_ids):
+        etas = defaultdict(list)
+        rows = (db.session.query(Phone.number, ManagedTask.eta)
+            .join(Alarm, Alarm.phone_id == Phone.id)
+            .join(ManagedTask, ManagedTask.alarm_id == Alarm.id)
+            .filter(Alarm.owner_id.in_(user_ids)))
+        for number, eta in rows:
+            etas[number].append(to_epoch(eta))
+
+        lateness, per_minute = [], defaultdict(int)
+        failures = 0
+        for resource, to, received_at, accepted in self.twilio.requests:
+            if not accepted:
+                failures += 1
+                continue
+            per_minute[int(received_at // 60)] += 1
+            due = [eta for eta in etas.get(to, ()) if eta <= received_at + 1]
+            if due:
+                lateness.append(received_at - max(due))
+
+        self.report.update({
+            'users': self.users,
+            'sends': len(lateness),
+            'send_failures': failures,
+            'peak_sends_per_minute': max(per_minute.values() or [0]),
+            'late_p50': percentile(lateness, 50),
+            'late_p95': percentile(lateness, 95),
+            'late_p99': percentile(lateness, 99),
+            'late_max': max(lateness or [0]),
+            'db_statements': self.counters.statements,
+            'broker_publishes': self.counters.publishes,
+            'tasks_executed': self.counters.executed,
+        })
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--users', type=int, default=1000)
+    parser.add_argument('--minutes', type=int, default=60)
+    parser.add_argument('--lead', type=int, default=2)
+    parser.add_argument('--seed', type=int, default=None)
+    parser.add_argument('--database-uri', default=None)
+    parser.add_argument('--broker', action='store_true',
+        help='publish to the real broker instead of running eagerly')
+    parser.add_argument('--twilio-port', type=int, default=0)
+    parser.add_argument('--latency', type=float, default=0.2)
+    parser.add_argument('--error-rate', type=float, default=0.0)
+    args = parser.parse_args()
+
+    if args.database_uri:
+        app.config['SQLALCHEMY_DATABASE_URI'] = args.database_uri
+    db.create_all()
+    twilio = FakeTwilioServer(('localhost', args.twilio_port),
+        latency=args.latency,
+        error_rate=args.error_rate,
+    )
+    twilio.start()
+    app.config['TWILIO_API_BASE'] = twilio.base_url
+    celery.conf.CELERY_ALWAYS_EAGER = not args.broker
+
+    simulator = MorningSimulator(args.users, args.minutes,
+        lead=args.lead,
+        seed=args.seed,
+        twilio=twilio,
+    )
+    report = simulator.run()
+    for key in sorted(report):
+        print("{:<24} {}".format(key, report[key]))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,186 @@
+"""Queue based logging. Request and worker threads only put records on a
+queue; a background listener thread does the file writes and the error
+emails, so a burst of errors never holds up the code that logged them.
+"""
+from __future__ import absolute_import, division, print_function
+from collections import OrderedDict
+import copy
+import logging
+import os
+import Queue
+import threading
+import time
+
+class QueueHandler(logging.Handler):
+    """Puts records on a listener's queue, after merging their arguments
+    into the message and rendering any traceback to text, so they are safe
+    to hand to another thread. A backport of the Python 3 handler, except
+    that it starts the listener in whichever process first logs through it.
+    """
+
+    def __init__(self, listener):
+        logging.Handler.__init__(self)
+        self.listener = listener
+
+    def prepare(self, record):
+        # Other handlers may still format the same record, so flatten a copy.
+        record = copy.copy(record)
+        record.msg = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            if not record.exc_text:
+                record.exc_text = logging.Formatter().formatException(
+                    record.exc_info)
+            record.exc_info = None
+        return record
+
+    def handle(self, record):
+        # The queue does its own locking. Not taking the handler lock as well
+        # means a copy of it held at fork time cannot block a child.
+        rv = self.filter(record)
+        if rv:
+            self.emit(record)
+        return rv
+
+    def emit(self, record):
+        try:
+            self.listener.ensure_started()
+            self.listener.queue.put_nowait(self.prepare(record))
+        except Queue.Full:
+            pass
+        except Exception:
+            self.handleError(record)
+
+
+class QueueListener(object):
+    """Hands records from the queue to its handlers on a daemon thread. At
+    least every poll_interval seconds handlers with a tick() method get to
+    run it, whether or not records arrive.
+
+    Threads do not survive a fork, so the thread is started lazily by
+    ensure_started, once in each process that logs.
+    """
+    _sentinel = None
+
+    def __init__(self, queue, *handlers, **kwargs):
+        self.queue = queue
+        self.handlers = handlers
+        self.poll_interval = kwargs.get('poll_interval', 1.0)
+        self._thread = None
+        self._pid = None
+        self._lock = threading.Lock()
+
+    def ensure_started(self):
+        if self._pid != os.getpid():
+            with self._lock:
+                if self._pid != os.getpid():
+                    self.start()
+
+    def start(self):
+        if self._pid is not None:
+            # A forked child: the queue and handler locks were copied in
+            # whatever state the parent's threads held them.
+            self.queue = Queue.Queue(self.queue.maxsize)
+            for handler in self.handlers:
+                handler.createLock()
+        self._pid = os.getpid()
+        self._thread = threading.Thread(target=self._monitor)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        """Stops this process's thread once the records already queued are
+        handled, then flushes every handler.
+        """
+        if self._thread is None or self._pid != os.getpid():
+            return
+        self.queue.put(self._sentinel)
+        self._thread.join()
+        self._thread = None
+        for handler in self.handlers:
+            handler.flush()
+
+    def handle(self, record):
+        for handler in self.handlers:
+            if record.levelno >= handler.level:
+                handler.handle(record)
+
+    def tick(self):
+        for handler in self.handlers:
+            if hasattr(handler, 'tick'):
+                handler.tick()
+
+    def _monitor(self):
+        while True:
+            try:
+                record = self.queue.get(timeout=self.poll_interval)
+            except Queue.Empty:
+                self.tick()
+                continue
+            if record is self._sentinel:
+                break
+            try:
+                self.handle(record)
+            except Exception:
+                pass
+            self.tick()
+
+
+class DigestMailHandler(logging.Handler):
+    """Collects records and mails them as one digest at most every interval
+    seconds; after a quiet spell the first record goes out at once.
+    Records from the same place (level, file and line) are folded into one
+    entry with a count, and at most max_entries distinct entries are kept
+    per digest, so an error storm costs one email per interval.
+    """
+
+    def __init__(self, mail_handler, interval=300, max_entries=50):
+        logging.Handler.__init__(self)
+        self.mail_handler = mail_handler
+        self.interval = interval
+        self.max_entries = max_entries
+        self.entries = OrderedDict()
+        self.dropped = 0
+        self.last_sent = 0
+
+    def createLock(self):
+        logging.Handler.createLock(self)
+        if getattr(self, 'mail_handler', None) is not None:
+            self.mail_handler.createLock()
+
+    def emit(self, record):
+        key = (record.levelno, record.pathname, record.lineno)
+        entry = self.entries.get(key)
+        if entry is not None:
+            entry[1] += 1
+        elif len(self.entries) < self.max_entries:
+            self.entries[key] = [record, 1]
+        else:
+            self.dropped += 1
+
+    def tick(self):
+        if self.entries and time.time() - self.last_sent >= self.interval:
+            self.flush()
+
+    def flush(self):
+        if not self.entries:
+            return
+        entries, self.entries = self.entries.values(), OrderedDict()
+        dropped, self.dropped = self.dropped, 0
+        self.last_sent = time.time()
+
+        first = entries[0][0]
+        parts = []
+        for record, count in entries:
+            text = self.format(record)
+            if count > 1:
+                text = "{}\n(repeated {} times)".format(text, count)
+            parts.append(text)
+        if dropped:
+            parts.append("{} more records not shown".format(dropped))
+        digest = logging.makeLogRecord(dict(first.__dict__,
+            msg='\n\n'.join(parts),
+            args=None,
+            exc_text=None,
+        ))
+        self.mail_handler.handle(digest)
@@ -1,7 +1,6 @@
 from __future__ import absolute_import
-from datetime import datetime
 
-from .. import db
+from .. import clock, db
 
 class Phone(db.Model):
 
@@ -9,16 +8,18 @@ class Phone(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     number = db.Column(db.String(10), unique=True)
     verified = db.Column(db.Boolean)
+    verification_code = db.Column(db.String(10))
     created = db.Column(db.DateTime(timezone=False))
     owner_id = db.Column(db.Integer, db.ForeignKey('users.id'))
     owner = db.relationship('User',
         backref=db.backref('phones', lazy='dynamic'))
 
-    def __init__(self, number, owner, verified=False):
+    def __init__(self, number, owner, verified=False, verification_code=None):
         self.number = number
         self.owner = owner
         self.verified = verified
-        self.created = datetime.utcnow()
+        self.verification_code = verification_code
+        self.created = clock.utcnow()
 
     def __repr__(self):
         return "<Phone {}: {}>".format(self.id, self.number)
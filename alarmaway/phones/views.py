@@ -37,16 +37,17 @@ def add():
         db.session.add(new_phone)
         try:
             db.session.commit()
-        except IntegrityError, err:
+        except IntegrityError:
             form.phone_number.errors.append("Number is already registered.")
         except:
-            logger.error("Unknown exception caught in add_phone.\n%s" % err)
+            logger.exception("Unknown exception caught in add_phone.")
             flash("Oops, something went wrong... Please try again.")
         else:
-            logger.info("New phone added {}".format(new_phone))
+            logger.info("New phone added %s", new_phone)
             verification_code = generate_verification_code()
             task_manager.processPhoneVerification(new_phone, verification_code)
             session['verification_code'] = verification_code
+            session['verification_phone_id'] = new_phone.id
 
             if session.pop('firstphone', False):
                 session['firstalarm'] = True
@@ -89,38 +90,45 @@ def verify(phone_id):
     alert the user of status.
     """
 
-    if 'verification_code' not in session:
-        logger.info('attempted to verify phone with no code in session')
-        flash('No verification code found. Please request a new one.', 'error')
-        return redirect(url_for('users.home'))
     phone = Phone.query.filter_by(id=phone_id, owner=g.user).first()
     if not phone:
         flash('Phone not found or ownership not verified', 'error')
         return redirect(url_for('users.home'))
+    # Phones added in bulk carry their code, others keep it in session
+    # along with the id of the phone it was sent to.
+    verification_code = phone.verification_code
+    if (verification_code is None
+            and session.get('verification_phone_id') == phone.id):
+        verification_code = session.get('verification_code')
+    if verification_code is None:
+        logger.info('attempted to verify phone with no code in session')
+        flash('No verification code found. Please request a new one.', 'error')
+        return redirect(url_for('users.home'))
     form = PhoneVerificationForm(request.form)
     if form.validate_on_submit():
-        if form.verification_code.data != session['verification_code']:
+        if form.verification_code.data != verification_code:
             form.verification_code.errors.append('Invalid verification code')
             logger.info(
-                "Invalid verification attempt - user: {}, "
-                "attempt: {}, correct: {}".format(
-                    g.user,
-                    form.verification_code.data,
-                    session['verification_code'],
-            ))
+                "Invalid verification attempt - user: %s, "
+                "attempt: %s, correct: %s",
+                g.user,
+                form.verification_code.data,
+                verification_code,
+            )
         else:
             phone.verified = True
+            phone.verification_code = None
             db.session.add(phone)
             try:
                 db.session.commit()
             except:
                 logger.warn("""
                     Error updating phone status to verified
-                    phone id: %s, user id: %s""" % phone_id, g.user.id
+                    phone id: %s, user id: %s""", phone_id, g.user.id
                 )
                 flash('Oops, Something went wrong... Please try again', 'error')
             else:
-                logger.info("phone verified {}".format(phone))
+                logger.info("phone verified %s", phone)
                 flash('Phone successfully verified!', 'success')
                 return redirect(url_for('users.home'))
     flash_errors(form)
@@ -0,0 +1,286 @@
+"""Bulk onboarding of users, their phones and alarms from a csv or json
+lines stream, one user per row:
+
+    python -m alarmaway.provisioning crew.csv --report failures.csv
+
+Rows carry email, timezone and phone, and optionally name, password,
+alarms (local HH:MM times, ';' separated in csv or a list in json) and
+set_alarms (default true). Rows are read, validated and inserted a batch at
+a time, so memory stays flat however long the input is. Every row that
+cannot be imported is written to the report with its line number and the
+reason.
+"""
+from __future__ import absolute_import, division, print_function
+import argparse
+import csv
+import datetime
+from itertools import islice
+import json
+import os
+import sys
+
+from sqlalchemy.exc import IntegrityError
+from werkzeug import generate_password_hash
+
+from . import app, clock, db, task_manager, timezones
+from .alarms.models import Alarm
+from .phones.forms import validate_number
+from .phones.models import Phone
+from .users.models import User, pick_unique_name
+from .utils import generate_verification_code, get_timezone_list
+
+import logging
+logger = logging.getLogger('alarmaway')
+
+TRUE_VALUES = ('1', 'true', 'yes', 'y')
+
+class RowError(ValueError):
+    pass
+
+
+def read_rows(stream, format='csv'):
+    """Yields (line number, row dict) pairs from a csv (with a header row)
+    or json lines stream. A json line that does not parse is yielded as
+    None, for clean_row to reject.
+    """
+    if format == 'jsonl':
+        for line_no, line in enumerate(stream, 1):
+            if line.strip():
+                try:
+                    row = json.loads(line)
+                except ValueError:
+                    row = None
+                yield line_no, row
+    else:
+        for line_no, row in enumerate(csv.DictReader(stream), 2):
+            yield line_no, row
+
+def parse_alarm_times(value):
+    if not value:
+        return []
+    if not isinstance(value, list):
+        value = value.split(';')
+    try:
+        return [
+            datetime.datetime.strptime(alarm_time.strip(), '%H:%M').time()
+            for alarm_time in value if alarm_time.strip()
+        ]
+    except ValueError:
+        raise RowError("alarm times must be HH:MM")
+
+def clean_row(row, zones):
+    """Returns the row's fields validated and normalized, or raises
+    RowError.
+    """
+    if not isinstance(row, dict):
+        raise RowError("not a json object")
+    email = (row.get('email') or '').strip()
+    if '@' not in email:
+        raise RowError("invalid email")
+    timezone = (row.get('timezone') or '').strip()
+    if timezone not in zones:
+        raise RowError("unknown timezone {}".format(timezone))
+    number = validate_number((row.get('phone') or '').strip())
+    if not number:
+        raise RowError("invalid phone number")
+    set_alarms = row.get('set_alarms', True)
+    if not isinstance(set_alarms, bool):
+        set_alarms = str(set_alarms).strip().lower() in TRUE_VALUES
+    return {
+        'email': email,
+        'name': (row.get('name') or '').strip() or email.split('@')[0],
+        'password': row.get('password') or os.urandom(16).encode('hex'),
+        'timezone': timezone,
+        'number': number,
+        'alarms': parse_alarm_times(row.get('alarms')),
+        'set_alarms': set_alarms,
+    }
+
+
+class Provisioner(object):
+    """Imports rows in batches of batch_size, each in its own transaction,
+    and reports the rows it had to skip through report(line_no, email,
+    reason).
+    """
+
+    def __init__(self, report, batch_size=None):
+        self.report = report
+        self.batch_size = batch_size or app.config.get(
+            'PROVISION_BATCH_SIZE', 200)
+        self.zones = set(get_timezone_list())
+        self.imported = 0
+        self.failed = 0
+
+    def run(self, rows):
+        rows = iter(rows)
+        while True:
+            batch = list(islice(rows, self.batch_size))
+            if not batch:
+                break
+            self.import_batch(batch)
+        logger.info("provisioning imported %s users, %s rows failed",
+            self.imported, self.failed)
+        return self.imported, self.failed
+
+    def fail(self, line_no, email, reason):
+        self.failed += 1
+        self.report(line_no, email, reason)
+
+    def import_batch(self, batch):
+        """Imports a batch of (line_no, row) pairs as read from the input."""
+        cleaned = []
+        emails, numbers = set(), set()
+        for line_no, row in batch:
+            email = row.get('email') if isinstance(row, dict) else None
+            try:
+                fields = clean_row(row, self.zones)
+            except RowError as err:
+                self.fail(line_no, email, str(err))
+                continue
+            except (AttributeError, TypeError, ValueError):
+                self.fail(line_no, email, "malformed row")
+                continue
+            if fields['email'].lower() in emails:
+                self.fail(line_no, fields['email'], "duplicate email in input")
+            elif fields['number'] in numbers:
+                self.fail(line_no, fields['email'], "duplicate phone in input")
+            else:
+                emails.add(fields['email'].lower())
+                numbers.add(fields['number'])
+                cleaned.append((line_no, fields))
+        if cleaned:
+            self.import_cleaned(cleaned)
+
+    def import_cleaned(self, rows):
+        """Imports (line_no, fields) pairs already through clean_row,
+        skipping those whose email or phone is registered already.
+        """
+        taken_emails = set(email.lower() for email, in db.session
+            .query(User.email)
+            .filter(db.func.lower(User.email).in_(
+                [fields['email'].lower() for _, fields in rows])))
+        taken_numbers = set(number for number, in db.session
+            .query(Phone.number)
+            .filter(Phone.number.in_(
+                [fields['number'] for _, fields in rows])))
+        free = []
+        for line_no, fields in rows:
+            if fields['email'].lower() in taken_emails:
+                self.fail(line_no, fields['email'], "email already registered")
+            elif fields['number'] in taken_numbers:
+                self.fail(line_no, fields['email'], "phone already registered")
+            else:
+                free.append((line_no, fields))
+        if not free:
+            return
+
+        try:
+            self.insert(free)
+        except IntegrityError:
+            # Someone signed up with one of these meanwhile; find out who
+            # by importing the rows one at a time.
+            db.session.rollback()
+            if len(free) == 1:
+                line_no, fields = free[0]
+                self.fail(line_no, fields['email'], "conflicts with a signup")
+            else:
+                for row in free:
+                    self.import_cleaned([row])
+
+    def insert(self, rows):
+        """Inserts the users, phones and alarms of the batch with one
+        statement per table, then sends their verification sms and sets
+        their alarms in bulk.
+        """
+        now = clock.utcnow()
+        taken = User.get_taken_names(fields['name'] for _, fields in rows)
+        user_rows = []
+        for _, fields in rows:
+            name = pick_unique_name(fields['name'], taken)
+            taken.add(name.lower())
+            user_rows.append({
+                'name': name,
+                'email': fields['email'],
+                'password': generate_password_hash(fields['password']),
+                'timezone': fields['timezone'],
+                'created': now,
+            })
+        db.session.execute(User.__table__.insert(), user_rows)
+        user_ids = dict(db.session.query(User.email, User.id)
+            .filter(User.email.in_([row['email'] for row in user_rows])))
+
+        codes = {}
+        phone_rows = []
+        for _, fields in rows:
+            codes[fields['number']] = generate_verification_code()
+            phone_rows.append({
+                'number': fields['number'],
+                'verified': False,
+                'verification_code': codes[fields['number']],
+                'created': now,
+                'owner_id': user_ids[fields['email']],
+            })
+        db.session.execute(Phone.__table__.insert(), phone_rows)
+        phone_ids = dict(db.session.query(Phone.number, Phone.id)
+            .filter(Phone.number.in_(list(codes))))
+
+        alarm_rows = []
+        for _, fields in rows:
+            utc_times = timezones.get_utc_times(
+                (local_time, fields['timezone'])
+                for local_time in fields['alarms'])
+            for local_time, utc_time in zip(fields['alarms'], utc_times):
+                alarm_rows.append({
+                    'time': utc_time,
+                    'local_time': local_time,
+                    'timezone': fields['timezone'],
+                    'active': False,
+                    'generation': 0,
+                    'created': now,
+                    'owner_id': user_ids[fields['email']],
+                    'phone_id': phone_ids[fields['number']],
+                })
+        if alarm_rows:
+            db.session.execute(Alarm.__table__.insert(), alarm_rows)
+        db.session.commit()
+        self.imported += len(rows)
+
+        task_manager.processPhoneVerifications(
+            (phone_ids[number], code) for number, code in codes.items())
+        set_owners = [user_ids[fields['email']] for _, fields in rows
+            if fields['set_alarms'] and fields['alarms']]
+        if set_owners:
+            task_manager.processSetAlarms(Alarm.query
+                .filter(Alarm.owner_id.in_(set_owners))
+                .order_by(Alarm.id))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('input', nargs='?', default='-')
+    parser.add_argument('--format', choices=('csv', 'jsonl'), default=None,
+        help='defaults to the input file extension, else csv')
+    parser.add_argument('--report', default='-',
+        help='where to write failed rows as csv (default stdout)')
+    parser.add_argument('--batch-size', type=int, default=None)
+    args = parser.parse_args()
+
+    format = args.format
+    if format is None:
+        format = 'jsonl' if args.input.endswith(('.jsonl', '.json')) else 'csv'
+    source = sys.stdin if args.input == '-' else open(args.input, 'rb')
+    report_file = sys.stdout if args.report == '-' else open(args.report, 'wb')
+    writer = csv.writer(report_file)
+    writer.writerow(['line', 'email', 'error'])
+
+    def report(line_no, email, reason):
+        if isinstance(email, unicode):
+            email = email.encode('utf-8')
+        writer.writerow([line_no, email, reason])
+
+    provisioner = Provisioner(report, batch_size=args.batch_size)
+    imported, failed = provisioner.run(read_rows(source, format))
+    print("imported {}, failed {}".format(imported, failed), file=sys.stderr)
+
+if __name__ == '__main__':
+    main()
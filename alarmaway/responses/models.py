@@ -0,0 +1,22 @@
+from __future__ import absolute_import
+
+from .. import clock, db
+
+class InboundMessage(db.Model):
+    """Records each inbound sms by its Twilio sid, so that repeated webhook
+    deliveries of the same message are only processed once.
+    """
+
+    __tablename__ = 'inbound_messages'
+    id = db.Column(db.Integer, primary_key=True)
+    sid = db.Column(db.String(40), unique=True)
+    phone_id = db.Column(db.Integer, db.ForeignKey('phones.id'))
+    received = db.Column(db.DateTime(timezone=False), index=True)
+
+    def __init__(self, sid, phone_id=None):
+        self.sid = sid
+        self.phone_id = phone_id
+        self.received = clock.utcnow()
+
+    def __repr__(self):
+        return "<InboundMessage {}: {}>".format(self.id, self.sid)
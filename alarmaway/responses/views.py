@@ -1,36 +1,77 @@
 from __future__ import absolute_import
+from collections import OrderedDict
 from flask import Blueprint, request
 import logging
+import threading
+from sqlalchemy import and_
 import twilio.twiml
 
-from .. import task_manager
+from .. import db
+from ..alarms.models import Alarm
+from ..celery import tasks
 from ..phones.models import Phone
 
 mod = Blueprint('responses', __name__, url_prefix='/responses')
 logger = logging.getLogger("alarmaway")
 
+def build_sms_response(message):
+    resp = twilio.twiml.Response()
+    resp.sms(message)
+    return str(resp)
+
+# Twilio waits on this webhook, so the replies are built once up front.
+ACKNOWLEDGED_RESPONSE = build_sms_response('Great, Have a nice day!')
+NO_ALARMS_RESPONSE = build_sms_response('No alarms running!')
+UNKNOWN_NUMBER_RESPONSE = build_sms_response(
+    'This number is not registered with AlarmAway.')
+
+# Message sids recently queued by this process, newest last.
+RECENT_SIDS_SIZE = 1024
+_recent_sids = OrderedDict()
+_recent_sids_lock = threading.Lock()
+
+def seen_recently(sid):
+    """Remembers sid, returning True if this process has queued it before."""
+    with _recent_sids_lock:
+        if sid in _recent_sids:
+            return True
+        _recent_sids[sid] = True
+        if len(_recent_sids) > RECENT_SIDS_SIZE:
+            _recent_sids.popitem(last=False)
+        return False
+
 @mod.route('/receive', methods=['POST'])
 def alarm_response():
+    """Twilio's inbound sms webhook. Looks up the sender's phone and active
+    alarms in one indexed query, queues the actual response handling and
+    answers straight away.
+    """
     from_number = request.values.get('From', None)
-    logger.info('SMS received -- from: {from_number}, mod: {modified}'
-        .format(from_number=from_number, modified=from_number[2:])
-    )
-    from_number = from_number[2:]
-    from_phone = Phone.query.filter_by(number=from_number).first()
-    if not from_phone:
-        logger.error("Received SMS from unknown number {}".format(from_number))
-        generate_join_message(new_number=from_number)
-        return
-    alarms = from_phone.alarms.filter_by(active=True).all()
-    if not alarms:
-        logger.info("SMS received with no alarms running - phone: {}".format(
-            from_phone))
-        resp_message = 'No alarms running!'
-    else:
-        for alarm in alarms:
-            task_manager.processAlarmResponse(alarm)
-            logger.info("successful sms alarm turn off/reset {}".format(alarm))
-        resp_message = 'Great, Have a nice day!'
-    resp = twilio.twiml.Response()
-    resp.sms(resp_message)
-    return str(resp)
+    sid = request.values.get('MessageSid') or request.values.get('SmsSid')
+    logger.info('SMS received -- from: %s, sid: %s', from_number, sid)
+    from_number = (from_number or '')[2:]
+    rows = (db.session.query(Phone.id, Alarm.id)
+        .outerjoin(Alarm, and_(
+            Alarm.phone_id == Phone.id,
+            Alarm.active == True,
+        ))
+        .filter(Phone.number == from_number)
+        .all())
+    if not rows:
+        logger.warn("Received SMS from unknown number %s", from_number)
+        return UNKNOWN_NUMBER_RESPONSE
+
+    phone_id = rows[0][0]
+    alarm_ids = [alarm_id for _, alarm_id in rows if alarm_id is not None]
+    if not alarm_ids:
+        logger.info("SMS received with no alarms running - phone: %s",
+            phone_id)
+        return NO_ALARMS_RESPONSE
+
+    if sid is None or not seen_recently(sid):
+        tasks.process_alarm_responses.apply_async(
+            args=(alarm_ids,),
+            kwargs=dict(message_sid=sid, phone_id=phone_id),
+        )
+        logger.info("queued sms alarm turn off/reset %s", alarm_ids)
+    return ACKNOWLEDGED_RESPONSE
@@ -0,0 +1,109 @@
+"""Cached timezone lookups and utc/local conversion, one at a time or in
+batches. Every zone is loaded once per process and its utc offset
+transitions are kept as a sorted table, so a conversion is a bisect and an
+addition rather than a pytz lookup and normalize.
+"""
+from __future__ import absolute_import, division, print_function
+from bisect import bisect_right
+import datetime
+
+import pytz
+
+from . import clock
+
+class ZoneTable(object):
+    """The utc offset transitions of one zone."""
+
+    def __init__(self, zone):
+        self.zone = zone
+        transitions = getattr(zone, '_utc_transition_times', None)
+        if transitions:
+            self.transitions = list(transitions)
+            self.offsets = [info[0] for info in zone._transition_info]
+        else:
+            self.transitions = []
+            self.offsets = [zone.utcoffset(datetime.datetime(2000, 1, 1))]
+
+    def offset_at(self, utc_dt):
+        """Returns the zone's utc offset at the given naive utc datetime."""
+        index = bisect_right(self.transitions, utc_dt) - 1
+        return self.offsets[max(index, 0)]
+
+    def to_local(self, utc_dt):
+        return utc_dt + self.offset_at(utc_dt)
+
+    def has_transition(self, start, end):
+        """Whether the utc offset changes between the naive utc datetimes
+        start and end.
+        """
+        return (bisect_right(self.transitions, start)
+            != bisect_right(self.transitions, end))
+
+    def to_utc(self, local_dt):
+        """Returns the naive utc datetime of the given naive local one. Wall
+        times skipped by a transition take the offset in force after it,
+        repeated ones their first occurrence.
+        """
+        return local_dt - self.offset_at(local_dt - self.offset_at(local_dt))
+
+
+_tables = {}
+
+def get_table(tz):
+    table = _tables.get(tz)
+    if table is None:
+        table = _tables[tz] = ZoneTable(pytz.timezone(tz or 'UTC'))
+    return table
+
+def get_zone(tz):
+    """Returns the cached pytz zone for the given name."""
+    return get_table(tz).zone
+
+def to_local(utc_dt, tz):
+    """Converts a naive utc datetime to a naive local one in zone tz."""
+    return get_table(tz).to_local(utc_dt)
+
+def to_utc(local_dt, tz):
+    """Converts a naive local datetime in zone tz to a naive utc one."""
+    return get_table(tz).to_utc(local_dt)
+
+def has_transition(tz, start, end):
+    return get_table(tz).has_transition(start, end)
+
+def localize(utc_dt, tz):
+    """Returns the naive utc datetime as an aware datetime in zone tz."""
+    return get_zone(tz).normalize(utc_dt.replace(tzinfo=pytz.utc))
+
+def to_local_many(items):
+    """Converts (naive utc datetime, tz) pairs to naive local datetimes."""
+    return [get_table(tz).to_local(utc_dt) for utc_dt, tz in items]
+
+def get_utc_times(items, now=None):
+    """Converts (local time, tz) pairs to utc times at each zone's current
+    offset, looking every zone's offset up once for the whole batch.
+    """
+    if now is None:
+        now = clock.utcnow()
+    offsets = {}
+    utc_times = []
+    for local_tm, tz in items:
+        offset = offsets.get(tz)
+        if offset is None:
+            offset = offsets[tz] = get_table(tz).offset_at(now)
+        utc_times.append((datetime.datetime.combine(now.date(),
+            local_tm.replace(second=0, microsecond=0, tzinfo=None))
+            - offset).time())
+    return utc_times
+
+def get_local_times(items, now=None):
+    """Converts (utc time, tz) pairs to the local times they fall at
+    today.
+    """
+    if now is None:
+        now = clock.utcnow()
+    today = now.date()
+    return [
+        get_table(tz).to_local(datetime.datetime.combine(today,
+            utc_tm.replace(second=0, microsecond=0, tzinfo=None))).time()
+        for utc_tm, tz in items
+    ]
@@ -0,0 +1,75 @@
+from __future__ import absolute_import
+from collections import OrderedDict
+import threading
+
+from sqlalchemy import event
+from sqlalchemy.orm.util import identity_key
+
+from .. import app, clock, db
+from .models import User
+
+class UserCache(object):
+    """A bounded, per-process LRU of detached User rows keyed by id, each
+    entry expiring ttl seconds after it was loaded.
+
+    Updates and deletes only evict the entry in the process that made them;
+    other processes keep serving their copy until its ttl runs out.
+    """
+
+    def __init__(self, size=1024, ttl=60):
+        self.size = size
+        self.ttl = ttl
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, user_id):
+        with self._lock:
+            entry = self._entries.pop(user_id, None)
+            if entry is None:
+                return None
+            user, loaded = entry
+            if clock.time() - loaded > self.ttl:
+                return None
+            self._entries[user_id] = entry
+            return user
+
+    def set(self, user_id, user):
+        with self._lock:
+            self._entries.pop(user_id, None)
+            self._entries[user_id] = (user, clock.time())
+            while len(self._entries) > self.size:
+                self._entries.popitem(last=False)
+
+    def invalidate(self, user_id):
+        with self._lock:
+            self._entries.pop(user_id, None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+user_cache = UserCache(
+    size=app.config.get('USER_CACHE_SIZE', 1024),
+    ttl=app.config.get('USER_CACHE_TTL', 60),
+)
+
+def load_user(user_id):
+    """Returns the User with the given id attached to the current session,
+    only querying the database when it is not already cached.
+    """
+    present = db.session.identity_map.get(identity_key(User, user_id))
+    if present is not None:
+        return present
+    user = user_cache.get(user_id)
+    if user is None:
+        user = User.query.get(user_id)
+        if user is None:
+            return None
+        db.session.expunge(user)
+        user_cache.set(user_id, user)
+    return db.session.merge(user, load=False)
+
+@event.listens_for(User, 'after_update')
+@event.listens_for(User, 'after_delete')
+def invalidate_user(mapper, connection, target):
+    user_cache.invalidate(target.id)
@@ -0,0 +1,51 @@
+from __future__ import absolute_import
+from sqlalchemy.orm import joinedload
+
+from .. import clock, timezones
+from ..alarms.models import Alarm
+from ..phones.models import Phone
+
+class HomeDashboard(object):
+    """Everything users.home renders for one user, read in two queries (one
+    for phones, one for alarms with their phones joined) however many rows
+    the user has. Nothing the template touches lazy loads.
+    """
+
+    def __init__(self, user, now=None):
+        if now is None:
+            now = clock.utcnow()
+        self.user = user
+        self.phones = (Phone.query
+            .filter_by(owner_id=user.id)
+            .order_by(Phone.id)
+            .all())
+        self.alarms = (Alarm.query
+            .options(joinedload(Alarm.phone))
+            .filter_by(owner_id=user.id)
+            .order_by(Alarm.id)
+            .all())
+        self.active_count = sum(1 for alarm in self.alarms if alarm.active)
+        self.unverified_phone = next(
+            (phone for phone in self.phones if not phone.verified), None)
+        self.next_runs = self.get_next_runs(now)
+
+    def get_next_runs(self, now):
+        """Returns {alarm id: next local run datetime} for every active
+        alarm, in the alarm's own timezone, converting the whole list in one
+        batch.
+        """
+        active = [alarm for alarm in self.alarms if alarm.active]
+        local_times = timezones.to_local_many(
+            (self.get_next_fire_at(alarm, now),
+                alarm.timezone or self.user.timezone)
+            for alarm in active
+        )
+        return dict(zip([alarm.id for alarm in active], local_times))
+
+    def get_next_fire_at(self, alarm, now):
+        """Returns the alarm's next utc fire time, worked out from its local
+        time when next_fire_at is unset or has already passed.
+        """
+        if alarm.next_fire_at is not None and alarm.next_fire_at > now:
+            return alarm.next_fire_at
+        return alarm.get_next_fire_time(now)
@@ -1,9 +1,21 @@
 from __future__ import absolute_import
-from datetime import datetime
 
-from .. import db
+from sqlalchemy.exc import IntegrityError
+
+from .. import clock, db
 from . import constants as USER
 
+def pick_unique_name(name, taken):
+    """Returns name, or name with the lowest numeric suffix from 2 up, that
+    is not in the set of lowercased taken names.
+    """
+    if name.lower() not in taken:
+        return name
+    version = 2
+    while (name + str(version)).lower() in taken:
+        version += 1
+    return name + str(version)
+
 class User(db.Model):
 
     __tablename__ = 'users'
@@ -20,9 +32,10 @@ class User(db.Model):
         self.email = email
         self.password = password
         self.timezone = timezone
-        self.created = datetime.utcnow()
+        self.created = clock.utcnow()
         if name is None:
             name = self.email.split('@')[0]
+        self.base_name = name
         self.name = User.make_unique_name(name)
 
     def getRole(self):
@@ -33,15 +46,47 @@ class User(db.Model):
 
     @staticmethod
     def make_unique_name(name):
-        if not User.query.filter_by(name=name).first():
-            return name
-        version = 2
-        while True:
-            new_name = name + str(version)
-            if not User.query.filter_by(name=new_name).first():
-                break
-            version += 1
-        return new_name
+        """Returns name, or name with the lowest free numeric suffix from 2
+        up, reading every name it could clash with in a single query.
+        """
+        return pick_unique_name(name, User.get_taken_names([name]))
+
+    @staticmethod
+    def get_taken_names(names):
+        """Returns the lowercased names of every user whose name starts with
+        one of the given names, in a single query. Names compare case
+        insensitively, as they do in most collations.
+        """
+        patterns = [
+            name.replace('\\', '\\\\')
+                .replace('%', '\\%')
+                .replace('_', '\\_') + '%'
+            for name in set(names)
+        ]
+        return set(taken_name.lower() for taken_name, in db.session
+            .query(User.name)
+            .filter(db.or_(*[
+                User.name.like(pattern, escape='\\') for pattern in patterns
+            ])))
+
+    def save(self, attempts=3):
+        """Adds and commits a new user. If a concurrent signup claimed the
+        same name first, a fresh one is chosen and the commit retried.
+        Other conflicts, such as a taken email, raise IntegrityError.
+        """
+        for attempt in range(attempts):
+            db.session.add(self)
+            try:
+                db.session.commit()
+                return self
+            except IntegrityError:
+                db.session.rollback()
+                name_taken = (db.session.query(User.id)
+                    .filter(User.name == self.name)
+                    .first())
+                if name_taken is None or attempt + 1 == attempts:
+                    raise
+                self.name = User.make_unique_name(self.base_name)
 
     def getStatus(self):
         return USER.STATUS[self.status]
@@ -7,6 +7,7 @@ from werkzeug import check_password_hash, generate_password_hash
 
 from .. import db, task_manager
 from ..utils import flash_errors, generate_verification_code
+from .dashboard import HomeDashboard
 from .decorators import login_required, non_login_required
 from .forms import LoginForm, MainRegisterForm
 from .models import User
@@ -30,9 +31,8 @@ def register():
             password=generate_password_hash(form.password.data),
             timezone = form.timezone.data,
             )
-        db.session.add(new_user)
         try:
-            db.session.commit()
+            new_user.save()
         except IntegrityError:
             form.email.errors.append(
                 "Username/Email associated with an existing account",
@@ -40,7 +40,7 @@ def register():
             flash_errors(form)
             return render_template('/users/register.html', form=form)
         else:
-            logger.info("New user created: {}".format(new_user))
+            logger.info("New user created: %s", new_user)
             task_manager.processWelcomeEmail(new_user)
 
         new_phone = Phone(
@@ -60,10 +60,11 @@ def register():
             flash_errors(form)
             return redirect(url_for('phones.add'))
         else:
-            logger.info("New phone created: {}".format(new_phone))
+            logger.info("New phone created: %s", new_phone)
             verification_code = generate_verification_code()
             task_manager.processPhoneVerification(new_phone, verification_code)
             session['verification_code'] = verification_code
+            session['verification_phone_id'] = new_phone.id
 
         session['user_id'] = new_user.id
         return redirect(url_for('users.home')) # END form.validate_on_submit
@@ -83,16 +84,15 @@ def trial():
             name=form.name.data,
             timezone=form.timezone.data,
         )
-        db.session.add(user)
         try:
-            db.session.commit()
+            user.save()
         except IntegrityError:
             form.email.errors.append(
                 "Username/Email associated with an existing account",
                 )
         else:
             task_manager.processWelcomeEmail(user)
-            logger.info("New user registered: {}".format(user))
+            logger.info("New user registered: %s", user)
             session['user_id'] = user.id
             session['firstphone'] = True
             return redirect(url_for('phones.add'))
@@ -110,24 +110,21 @@ def home():
     signing up or logging in. Displays basic user, phone, and alarm data.
     """
 
-    user = g.user
+    dashboard = HomeDashboard(g.user)
     need_verify_phone, form = None, None
-    alarms = user.alarms.all()
-    phones = user.phones.all()
-    if not phones:
+    if not dashboard.phones:
         form = PhoneForm(request.form)
-    else:
-        for phone in phones:
-            if not phone.verified:
-                need_verify_phone = phone.id
-                form = PhoneVerificationForm(request.form)
-                break
+    elif dashboard.unverified_phone is not None:
+        need_verify_phone = dashboard.unverified_phone.id
+        form = PhoneVerificationForm(request.form)
     return render_template('users/home.html',
-        user=user,
+        user=dashboard.user,
         verify_phone=need_verify_phone,
         form=form,
-        alarms=alarms,
-        phones=phones,
+        alarms=dashboard.alarms,
+        phones=dashboard.phones,
+        next_runs=dashboard.next_runs,
+        active_count=dashboard.active_count,
         )
 
 @mod.route('/account')
@@ -152,10 +149,10 @@ def login():
             form.email.errors.append('No account found with that email address')
         elif not check_password_hash(user.password, form.password.data):
             form.password.errors.append("Invalid password")
-            logger.info("Invalid password attempt for user {}".format(user))
+            logger.info("Invalid password attempt for user %s", user)
         else:
             session['user_id'] = user.id
-            logger.info("Successful user login: {}".format(user.id))
+            logger.info("Successful user login: %s", user.id)
             return redirect(url_for('users.home'))
     flash_errors(form)
     return render_template('users/login.html', signin_form=form, form=form)
@@ -166,8 +163,8 @@ def logout():
     Logs the user out.
     """
 
-    logger.info("Logout popping verification_code {}".format(
-        session.pop('verification_code', "None")))
-    logger.info("Logout popping user_id {}".format(
-        session.pop('user_id', "None")))
+    logger.info("Logout popping verification_code %s",
+        session.pop('verification_code', "None"))
+    session.pop('verification_phone_id', None)
+    logger.info("Logout popping user_id %s", session.pop('user_id', "None"))
     return redirect(url_for('frontend.home'))
@@ -1,9 +1,10 @@
 from __future__ import absolute_import, division, print_function
-from datetime import datetime
 import random
 from flask import flash
 import pytz
 
+from . import timezones
+
 def flash_errors(form):
     """Helper method to render all of the errors in the given form
     as flask flash_messages for formatted display.
@@ -28,24 +29,12 @@ def get_timezone_list():
 
 def get_utc(local_tm, tz):
     """Takes a datetime.time() object and a string representing a timezone,
-       and uses this information and the pytz library to convert time to UTC.
+       and converts the time to UTC at the timezone's current offset.
     """
-    utc_tz = pytz.utc
-    utc_now = datetime.utcnow().replace(tzinfo=utc_tz)
-    local_tz = pytz.timezone(tz)
-    local_now = local_tz.normalize(utc_now)
-    local_alarm = local_now.replace(hour=local_tm.hour, minute=local_tm.minute)
-    utc_alarm = utc_tz.normalize(local_alarm)
-    return utc_alarm.time()
+    return timezones.get_utc_times([(local_tm, tz)])[0]
 
 def get_local(utc_time, tz):
     """Takes a datetime.time() object and a string representing a timezone,
-       and uses this information and the pytz library to convert this UTC
-       time to a local time in the given timezone.
+       and converts this UTC time to a local time in the given timezone.
     """
-    utc_tz = pytz.utc
-    utc_now = datetime.utcnow().replace(tzinfo=utc_tz)
-    utc_alarm = utc_now.replace(hour=utc_time.hour, minute=utc_time.minute)
-    local_tz = pytz.timezone(tz)
-    local_alarm = local_tz.normalize(utc_alarm)
-    return local_alarm.time()
+    return timezones.get_local_times([(utc_time, tz)])[0]
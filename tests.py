@@ -1,8 +1,32 @@
+from contextlib import contextmanager
+import json
+import logging
 import os
+import Queue
 import unittest
+from datetime import datetime, timedelta
+
+from sqlalchemy import event
 
 from config import _basedir
-from alarmaway import app, db
+from alarmaway import app, clock, db, emails, task_manager
+from alarmaway.alarms.models import Alarm
+from alarmaway.celery import constants as TASK, provider
+from alarmaway.celery.dispatcher import Dispatcher
+from alarmaway.celery.metrics import Histogram
+from alarmaway.celery.models import ManagedTask, QueuedEmail, TaskHistory
+from alarmaway.celery.ratelimit import MemoryBackend, RateLimiter
+from alarmaway.celery.task_manager import get_step_job
+from alarmaway.celery.celery import celery
+from alarmaway.celery.tasks import (flush_email_queue, is_stale_step,
+    process_alarm_responses, send_batch)
+from alarmaway.loadtest.fake_twilio import FakeTwilioServer
+from alarmaway.logqueue import QueueHandler, QueueListener
+from alarmaway.phones.models import Phone
+from alarmaway.provisioning import RowError, clean_row, read_rows
+from alarmaway.responses.models import InboundMessage
+from alarmaway.users.cache import load_user, user_cache
+from alarmaway.users.dashboard import HomeDashboard
 from alarmaway.users.models import User
 
 
@@ -15,6 +39,9 @@ class AlarmAwayTestCase(unittest.TestCase):
             'sqlite:///' + os.path.join(_basedir, 'test.db'))
         self.app = app.test_client()
         db.create_all()
+        user_cache.clear()
+        # Alarm steps are only recorded, so no broker is needed.
+        task_manager.use_dispatcher = True
 
     def tearDown(self):
         db.session.remove()
@@ -35,6 +62,40 @@ class AlarmAwayTestCase(unittest.TestCase):
             app = self.app
         return app.get('/users/logout', follow_redirects=True)
 
+    def make_alarm(self, number, email='joe@me.com'):
+        """Creates an alarm on a new phone, for a new user unless email
+        already has one.
+        """
+        user = User.query.filter_by(email=email).first()
+        if user is None:
+            user = User(email=email, password='password',
+                timezone='America/Chicago').save()
+        phone = Phone(number, user, verified=True)
+        alarm = Alarm(time=datetime(2013, 3, 1, 12, 0).time(), owner=user,
+            phone=phone)
+        db.session.add(alarm)
+        db.session.commit()
+        return alarm
+
+    @contextmanager
+    def record_statements(self):
+        """Yields the list of SQL statements run inside the block. The
+        session gives up its connection first, so none are missed.
+        """
+        db.session.close()
+        statements = []
+        def record(conn, cursor, statement, *args):
+            statements.append(statement)
+        event.listen(db.engine, 'before_cursor_execute', record)
+        try:
+            yield statements
+        finally:
+            event.remove(db.engine, 'before_cursor_execute', record)
+
+    def get_outcomes(self, alarm_id):
+        return [(task.ended is not None, task.outcome) for task in
+            ManagedTask.query.filter_by(alarm_id=alarm_id)]
+
     def test_serverup(self):
         """Verify that the server is running and we get the homepage
         as requested. This also may check for a logged in user assuming
@@ -74,6 +135,36 @@ class AlarmAwayTestCase(unittest.TestCase):
         assert named_user.name != 'Joe'
         assert named_user.name != 'Joe2'
 
+    def test_make_unique_name_fills_gaps(self):
+        """Ensures the lowest free suffix is used and that other names
+        sharing the prefix do not interfere.
+        """
+        for name in ['Joe', 'Joe3', 'Joey', 'Jo_']:
+            User(email=name + '@me.com', password='password').save()
+        assert User.make_unique_name('Joe') == 'Joe2'
+        assert User.make_unique_name('Jo_') == 'Jo_2'
+        assert User.make_unique_name('Jo%') == 'Jo%'
+
+    def test_provisioning_rows(self):
+        """Ensures bulk import rows are read and validated one by one."""
+        stream = [
+            'email,timezone,phone,alarms\r\n',
+            'joe@me.com,America/Chicago,(555) 555-1234,07:00;07:30\r\n',
+            'bad,America/Chicago,5555551234,\r\n',
+        ]
+        rows = list(read_rows(stream))
+        assert [line_no for line_no, _ in rows] == [2, 3]
+        fields = clean_row(rows[0][1], ['America/Chicago'])
+        assert fields['number'] == '5555551234'
+        assert fields['name'] == 'joe'
+        assert len(fields['alarms']) == 2
+        self.assertRaises(RowError, clean_row, rows[1][1], ['America/Chicago'])
+        rows = list(read_rows(['{"email": "joe@me.com"}\n', '{oops\n', '[]\n'],
+            format='jsonl'))
+        assert [row for _, row in rows] == [{'email': 'joe@me.com'}, None, []]
+        self.assertRaises(RowError, clean_row, rows[1][1], ['America/Chicago'])
+        self.assertRaises(RowError, clean_row, rows[2][1], ['America/Chicago'])
+
     def test_login_logout(self):
         u_email = 'test@canopyinnovation.com'
         u_pass = 'password'
@@ -88,5 +179,437 @@ class AlarmAwayTestCase(unittest.TestCase):
         rv = self.app.get('/users/home')
         assert rv.status_code == 302
 
+    def test_api_etag(self):
+        """Ensures the api needs a login and answers unchanged data with a
+        304.
+        """
+        assert self.app.get('/api/phones').status_code == 401
+        user = User(email='joe@me.com', password='password',
+            timezone='America/Chicago').save()
+        with self.app.session_transaction() as sess:
+            sess['user_id'] = user.id
+        rv = self.app.get('/api/phones')
+        assert rv.status_code == 200
+        assert rv.data == '{"phones":[]}'
+        rv = self.app.get('/api/phones',
+            headers={'If-None-Match': rv.headers['ETag']})
+        assert rv.status_code == 304
+
+    def test_verify_phone_uses_its_own_code(self):
+        """Ensures a code kept in session only verifies the phone it was
+        sent to.
+        """
+        first = self.make_alarm('5555551234').phone
+        second = self.make_alarm('5555554321').phone
+        first_id, second_id = first.id, second.id
+        second.verified = False
+        db.session.commit()
+        with self.app.session_transaction() as sess:
+            sess['user_id'] = first.owner_id
+            sess['verification_code'] = '1234'
+            sess['verification_phone_id'] = first_id
+        self.app.post('/phones/verify/{}'.format(second_id),
+            data=dict(verification_code='1234'))
+        assert not Phone.query.get(second_id).verified
+
+    def test_user_cache(self):
+        """Ensures updating or deleting a user evicts its cache entry, and
+        that an entry is reloaded once its ttl runs out.
+        """
+        sim_clock = clock.SimulatedClock(datetime(2013, 3, 1, 12, 0))
+        previous = clock.set_clock(sim_clock)
+        try:
+            u_id = User(email='joe@me.com', password='password').save().id
+            db.session.remove()
+            load_user(u_id)
+            assert user_cache.get(u_id) is not None
+            load_user(u_id).name = 'Jim'
+            db.session.commit()
+            assert user_cache.get(u_id) is None
+
+            db.session.remove()
+            load_user(u_id)
+            users = User.__table__
+            db.session.execute(users.update()
+                .where(users.c.id == u_id)
+                .values(name='Jo'))
+            db.session.commit()
+            db.session.remove()
+            assert load_user(u_id).name == 'Jim'
+            db.session.remove()
+            sim_clock.advance(seconds=user_cache.ttl + 1)
+            assert load_user(u_id).name == 'Jo'
+
+            db.session.delete(load_user(u_id))
+            db.session.commit()
+            assert user_cache.get(u_id) is None
+        finally:
+            clock.set_clock(previous)
+
+    def test_dashboard_next_runs(self):
+        """Ensures the dashboard shows an alarm's next run at its local time
+        in the alarm's own timezone rather than the user's.
+        """
+        alarm = self.make_alarm('5555551234')
+        alarm.time = datetime(2013, 3, 1, 7, 0).time()
+        alarm.local_time = datetime(2013, 3, 1, 7, 0).time()
+        alarm.timezone = 'Europe/London'
+        alarm.active = True
+        db.session.commit()
+        dashboard = HomeDashboard(alarm.owner, now=datetime(2013, 3, 30, 8, 0))
+        assert dashboard.next_runs == {alarm.id: datetime(2013, 3, 31, 7, 0)}
+
+    def test_dispatcher_loads_due_steps(self):
+        """Ensures the dispatcher reads every unpublished step due this
+        minute, whatever order the rows were committed in.
+        """
+        for task_id, eta in [
+                (None, datetime(2013, 3, 1, 7, 3)),
+                (None, datetime(2013, 3, 1, 7, 0, 30)),
+                ('published', datetime(2013, 3, 1, 7, 0)),
+                (None, datetime(2013, 3, 1, 6, 59)),
+                (None, datetime(2013, 3, 1, 6, 50)),
+                ]:
+            db.session.add(ManagedTask(task_id=task_id, eta=eta))
+        db.session.commit()
+        dispatcher = Dispatcher(db)
+        assert dispatcher.load(datetime(2013, 3, 1, 7, 0, 45)) == [4, 2]
+        assert dispatcher.load(datetime(2013, 3, 1, 7, 3)) == [1]
+
+    def test_unset_alarm_skips_stale_steps(self):
+        """Ensures unsetting an alarm ends its pending steps and bumps its
+        generation, so steps already queued are skipped.
+        """
+        alarm = self.make_alarm('5555551234')
+        a_id = alarm.id
+        task_manager.processSetAlarm(alarm)
+        assert self.get_outcomes(a_id) == [(False, None)] * 6
+        assert not is_stale_step(a_id, 0)
+        task_manager.processUnsetAlarm(alarm)
+        db.session.expire_all()
+        alarm = Alarm.query.get(a_id)
+        assert alarm.generation == 1
+        assert not alarm.active
+        assert self.get_outcomes(a_id) == [(True, TASK.CANCELLED)] * 6
+        assert is_stale_step(a_id, 0)
+        assert not is_stale_step(a_id, 1)
+
+    def test_alarm_responses(self):
+        """Ensures a response acknowledges the pending steps, keeping
+        recurring alarms active and turning the others off.
+        """
+        recurring = self.make_alarm('5555551234')
+        once = self.make_alarm('5555554321')
+        ids = [recurring.id, once.id]
+        task_manager.processSetAlarms([recurring, once])
+        task_manager.processAlarmResponses([ids[0]], rearm=True)
+        task_manager.processAlarmResponses([ids[1]], rearm=False)
+        db.session.expire_all()
+        recurring, once = Alarm.query.get(ids[0]), Alarm.query.get(ids[1])
+        assert recurring.active and recurring.next_fire_at is not None
+        assert not once.active and once.next_fire_at is None
+        for alarm in (recurring, once):
+            assert alarm.generation == 1
+            assert alarm.last_acknowledged is not None
+            assert self.get_outcomes(alarm.id) == [(True, TASK.ACKNOWLEDGED)] * 6
+
+    def test_duplicate_sms_acknowledged_once(self):
+        """Ensures a repeated MessageSid acknowledges the alarm only once,
+        whether this process or another one saw it first.
+        """
+        alarm = self.make_alarm('5555551234')
+        a_id, phone_id = alarm.id, alarm.phone_id
+        task_manager.processSetAlarms([alarm])
+        eager = celery.conf.CELERY_ALWAYS_EAGER
+        celery.conf.CELERY_ALWAYS_EAGER = True
+        try:
+            for _ in range(2):
+                rv = self.app.post('/responses/receive', data=dict(
+                    From='+15555551234', MessageSid='SM123'))
+                assert rv.status_code == 200
+            process_alarm_responses([a_id], message_sid='SM123',
+                phone_id=phone_id)
+        finally:
+            celery.conf.CELERY_ALWAYS_EAGER = eager
+        db.session.expire_all()
+        assert Alarm.query.get(a_id).generation == 1
+        assert InboundMessage.query.count() == 1
+
+    def test_set_alarms_statement_count(self):
+        """Ensures setting alarms costs the same statements per batch
+        however many alarms the batch holds, with no reads per alarm.
+        """
+        for n in range(6):
+            self.make_alarm('555555000{}'.format(n))
+        batch_size, task_manager.batch_size = task_manager.batch_size, 3
+        try:
+            with self.record_statements() as statements:
+                alarms = Alarm.query.order_by(Alarm.id).all()
+                del statements[:]
+                task_manager.processSetAlarms(alarms)
+        finally:
+            task_manager.batch_size = batch_size
+        # One insert of steps and one update of alarms per batch.
+        assert len(statements) == 4
+        assert ManagedTask.query.count() == 36
+
+    def test_remove_phones_statement_count(self):
+        """Ensures removing phones takes the same statements however many
+        phones, alarms and tasks go with them.
+        """
+        alarms = [self.make_alarm('555555000{}'.format(n)) for n in range(4)]
+        phone_ids = [alarm.phone_id for alarm in alarms]
+        task_manager.processSetAlarms(alarms)
+        with self.record_statements() as statements:
+            task_manager.processRemovePhones(phone_ids[:1])
+        assert len(statements) == 5
+        with self.record_statements() as statements:
+            task_manager.processRemovePhones(phone_ids[1:])
+        assert len(statements) == 5
+        assert Phone.query.count() == 0
+        assert Alarm.query.count() == 0
+        assert ManagedTask.query.count() == 0
+
+    def test_fired_alarms_advance(self):
+        """Ensures alarms whose fire time has passed move on to their next
+        run, leaving the others alone.
+        """
+        fired = self.make_alarm('5555551234')
+        waiting = self.make_alarm('5555554321')
+        ids = [fired.id, waiting.id]
+        fired.active = waiting.active = True
+        fired.next_fire_at = datetime(2013, 3, 1, 12, 0)
+        waiting.next_fire_at = datetime(2013, 3, 2, 12, 0)
+        db.session.commit()
+        now = datetime(2013, 3, 1, 12, 1)
+        assert task_manager.processFiredAlarms(now) == 1
+        db.session.expire_all()
+        assert [Alarm.query.get(a_id).next_fire_at for a_id in ids] == [
+            datetime(2013, 3, 2, 12, 0)] * 2
+
+    def test_rearm_only_idle_alarms(self):
+        """Ensures re-arming schedules alarms whose run has finished and
+        leaves alone those with steps still pending.
+        """
+        pending = self.make_alarm('5555551234')
+        idle = self.make_alarm('5555554321')
+        ids = [pending.id, idle.id]
+        task_manager.processSetAlarms([pending, idle])
+        table = ManagedTask.__table__
+        db.session.execute(table.update()
+            .where(table.c.alarm_id == ids[1])
+            .values(ended=clock.utcnow(), outcome=TASK.SENT))
+        db.session.commit()
+        assert task_manager.processRearmAlarms() == 1
+        assert self.get_outcomes(ids[0]) == [(False, None)] * 6
+        assert sorted(self.get_outcomes(ids[1])) == (
+            [(False, None)] * 6 + [(True, TASK.SENT)] * 6)
+
+    def test_reschedule_skips_running_alarms(self):
+        """Ensures rescheduling leaves an alarm mid run alone, even once
+        processFiredAlarms has moved its next_fire_at on.
+        """
+        sim_clock = clock.SimulatedClock(datetime(2013, 3, 1, 11, 30))
+        previous = clock.set_clock(sim_clock)
+        try:
+            alarm = self.make_alarm('5555551234')
+            alarm.local_time = datetime(2013, 3, 1, 6, 0).time()
+            alarm.timezone = 'America/Chicago'
+            a_id = alarm.id
+            task_manager.processSetAlarms([alarm])
+            sim_clock.advance(minutes=31)
+            assert task_manager.processFiredAlarms() == 1
+            table = Alarm.__table__
+            db.session.execute(table.update()
+                .where(table.c.id == a_id)
+                .values(timezone='America/New_York'))
+            db.session.commit()
+            assert task_manager.processReschedule(Alarm.id == a_id) == 0
+            assert self.get_outcomes(a_id) == [(False, None)] * 6
+        finally:
+            clock.set_clock(previous)
+
+    def test_task_retention(self):
+        """Ensures old finished tasks are counted into TaskHistory, merging
+        with an existing row, while pending and recent tasks stay put.
+        """
+        alarm = self.make_alarm('5555551234')
+        a_id = alarm.id
+        task_manager.processSetAlarms([alarm])
+        m_ids = [m_id for m_id, in db.session.query(ManagedTask.id)
+            .order_by(ManagedTask.id)]
+        now = datetime(2013, 3, 10, 12, 0)
+        old = now - timedelta(days=5)
+        table = ManagedTask.__table__
+        db.session.execute(table.update()
+            .where(table.c.id.in_(m_ids[:3]))
+            .values(ended=old, outcome=TASK.SENT))
+        db.session.execute(table.update()
+            .where(table.c.id == m_ids[3])
+            .values(ended=now, outcome=TASK.SENT))
+        db.session.add(TaskHistory(a_id, old.date(), TASK.CALL, TASK.SENT, 3))
+        db.session.commit()
+        assert task_manager.processTaskRetention(now) == 3
+        assert sorted((h.action, h.outcome, h.count)
+            for h in TaskHistory.query.filter_by(alarm_id=a_id)) == sorted([
+                (TASK.CALL, TASK.SENT, 5), (TASK.SMS, TASK.SENT, 1)])
+        assert [m_id for m_id, in db.session.query(ManagedTask.id)
+            .order_by(ManagedTask.id)] == m_ids[3:]
+
+    def test_send_batch(self):
+        """Ensures a batch sends its live jobs and records the outcome of
+        every job, cancelling stale ones and expiring late ones.
+        """
+        alarm = self.make_alarm('5555551234')
+        a_id, phone_id = alarm.id, alarm.phone_id
+        task_manager.processSetAlarm(alarm)
+        m_ids = [m_id for m_id, in db.session.query(ManagedTask.id)
+            .order_by(ManagedTask.id)][:3]
+        now = clock.utcnow()
+        twilio = FakeTwilioServer(('localhost', 0), latency=0, jitter=0)
+        twilio.start()
+        app.config['TWILIO_API_BASE'] = twilio.base_url
+        provider._client = None
+        jobs = [
+            get_step_job(m_ids[0], TASK.CALL, phone_id, a_id, 0, now),
+            get_step_job(m_ids[1], TASK.SMS, phone_id, a_id, 5, now),
+            get_step_job(m_ids[2], TASK.CALL, phone_id, a_id, 0,
+                now - timedelta(minutes=10)),
+        ]
+        try:
+            # Jobs go through the broker as json.
+            send_batch(json.loads(json.dumps(jobs)))
+        finally:
+            twilio.shutdown()
+            twilio.server_close()
+            del app.config['TWILIO_API_BASE']
+            provider._client = None
+        tasks = ManagedTask.query.filter(ManagedTask.id.in_(m_ids)).order_by(
+            ManagedTask.id).all()
+        assert [task.outcome for task in tasks] == [
+            TASK.SENT, TASK.CANCELLED, TASK.EXPIRED]
+        assert all(task.ended is not None for task in tasks)
+        assert tasks[0].return_id.startswith('CA')
+        assert len(twilio.requests) == 1
+
+    def test_flush_email_queue(self):
+        """Ensures a refused email does not hold up the ones queued behind
+        it, and is dropped once it has used up its attempts.
+        """
+        app.config['EMAIL_MAX_ATTEMPTS'] = 2
+        mail_state = app.extensions['mail']
+        suppress, mail_state.suppress = mail_state.suppress, True
+        try:
+            for subject in ['first', 'bad\nsubject', 'third']:
+                emails.queue_email(subject,
+                    recipients=['joe@me.com'],
+                    sender='test@alarmaway.com',
+                    body_text='Hello',
+                )
+            assert flush_email_queue() == 2
+            assert [(email.subject, email.attempts)
+                for email in QueuedEmail.query] == [('bad\nsubject', 1)]
+            assert flush_email_queue() == 0
+            assert QueuedEmail.query.count() == 0
+        finally:
+            mail_state.suppress = suppress
+            del app.config['EMAIL_MAX_ATTEMPTS']
+
+    def test_remove_user_drops_queued_emails(self):
+        """Ensures removing a user also drops the emails queued for them."""
+        alarm = self.make_alarm('5555551234')
+        user = alarm.owner
+        emails.queue_email('hello', recipients=[user.email], user=user)
+        task_manager.processRemoveUser(user)
+        assert User.query.count() == 0
+        assert QueuedEmail.query.count() == 0
+
+    def test_lateness_histogram(self):
+        """Ensures lateness quantiles land in the right bucket."""
+        histogram = Histogram(bounds=(1, 10, 60, float('inf')))
+        for seconds in [0.2] * 90 + [30] * 9 + [600]:
+            histogram.observe(seconds)
+        assert histogram.quantile(0.5) <= 1
+        assert 10 < histogram.quantile(0.95) <= 60
+        assert histogram.quantile(1.0) == 60
+        assert histogram.count == 100
+
+    def test_rate_limiter_priority(self):
+        """Ensures a starved alarm call holds off lower priority sends until
+        it has had its token.
+        """
+        limiter = RateLimiter(MemoryBackend(), limits={'twilio': (1.0, 1.0)})
+        assert limiter.acquire('twilio', TASK.PRIORITY_MESSAGE, now=0) == 0
+        assert limiter.acquire('twilio', TASK.PRIORITY_CALL, now=0.5) > 0
+        assert limiter.acquire('twilio', TASK.PRIORITY_FOLLOWUP, now=1.2) > 0
+        assert limiter.acquire('twilio', TASK.PRIORITY_CALL, now=1.2) == 0
+
+    def test_alarm_keeps_local_time_across_dst(self):
+        """Ensures an alarm set for 7am local still rings at 7am local once
+        its zone moves to daylight time.
+        """
+        alarm = Alarm(
+            time=datetime(2013, 3, 1, 12, 0).time(),
+            local_time=datetime(2013, 3, 1, 7, 0).time(),
+            timezone='America/New_York',
+        )
+        assert (alarm.get_next_fire_time(datetime(2013, 3, 8, 12, 0))
+            == datetime(2013, 3, 9, 12, 0))
+        assert (alarm.get_next_fire_time(datetime(2013, 3, 9, 12, 0))
+            == datetime(2013, 3, 10, 11, 0))
+
+    def test_simulated_clock(self):
+        """Ensures scheduling reads the installed clock, so it can be
+        fast-forwarded.
+        """
+        sim_clock = clock.SimulatedClock(datetime(2013, 3, 1, 6, 30))
+        previous = clock.set_clock(sim_clock)
+        try:
+            alarm = Alarm(time=datetime(2013, 3, 1, 7, 0).time())
+            assert alarm.created == datetime(2013, 3, 1, 6, 30)
+            assert alarm.get_next_fire_time() == datetime(2013, 3, 1, 7, 0)
+            sim_clock.advance(hours=1)
+            assert alarm.get_next_fire_time() == datetime(2013, 3, 2, 7, 0)
+        finally:
+            clock.set_clock(previous)
+
+    def test_log_queue_after_fork(self):
+        """Ensures a record logged in a forked child reaches the listener's
+        handler there, and that queueing a record leaves it untouched for
+        other handlers.
+        """
+        class ListHandler(logging.Handler):
+            def emit(self, record):
+                self.records.append(record.getMessage())
+
+        target = ListHandler()
+        target.records = []
+        listener = QueueListener(Queue.Queue(), target)
+        logger = logging.Logger('test_log_queue_after_fork')
+        logger.addHandler(QueueHandler(listener))
+
+        record = logger.makeRecord(logger.name, logging.INFO, __file__, 0,
+            "parent %s", ('arg',), None)
+        logger.handle(record)
+        assert record.msg == "parent %s" and record.args == ('arg',)
+        listener.stop()
+        assert target.records == ["parent arg"]
+
+        read_fd, write_fd = os.pipe()
+        pid = os.fork()
+        if pid == 0:
+            try:
+                os.close(read_fd)
+                logger.info("child %s", os.getpid())
+                listener.stop()
+                os.write(write_fd, '\n'.join(target.records))
+            finally:
+                os._exit(0)
+        os.close(write_fd)
+        output = os.read(read_fd, 1024)
+        os.close(read_fd)
+        os.waitpid(pid, 0)
+        assert output.split('\n') == ["parent arg", "child {}".format(pid)]
+
 if __name__ == '__main__':
     unittest.main()